@@ -0,0 +1,104 @@
+"""
+Geminiへの画像の渡し方（フレームごと / コンタクトシート）のベンチマーク。
+
+同じクリップから analyze_and_generate_advice と同じ方法でフレームを選び、
+"frames"（1枚ずつ）と "grid"（1枚のグリッド画像）のペイロードを作って比較する。
+--call を付けると実際にGeminiを呼び、入力トークン数（usage_metadata）と応答時間も比べる
+（GEMINI_API_KEY が必要。RAGを通さないよう、プロンプトは固定の短い文にする）。
+
+使い方:
+    python benchmarks/gemini_image_mode_benchmark.py clip1.mp4 [clip2.mp4 ...] --start 0 --end 5
+    GEMINI_API_KEY=... python benchmarks/gemini_image_mode_benchmark.py clip.mp4 --call --runs 3 --json result.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# main.py をインポートする前に、ストレージをGCSに繋がないインメモリにしておく
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+MODES = ("frames", "grid")
+PROMPT = (
+    "These are frames from a bouldering attempt. Describe the climber's posture and movement "
+    "in three sentences."
+)
+
+def benchmark_clip(input_path: str, start_sec: float, end_sec: float, runs: int, call: bool) -> list:
+    frames, frame_times = main.extract_analysis_frames(input_path, start_sec, end_sec)
+    if not frames:
+        raise RuntimeError(f"No frames extracted from {input_path}")
+
+    rows = []
+    for mode in MODES:
+        build_times, call_times = [], []
+        parts, prompt_tokens = [], None
+        prompt = PROMPT + (main.CONTACT_SHEET_PROMPT_NOTES["English"] if mode == "grid" else "")
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            parts = main.select_gemini_images(frames, mode, frame_times)
+            build_times.append(time.perf_counter() - start_time)
+
+            if call:
+                model = main.get_gemini_model()
+                start_time = time.perf_counter()
+                response = model.generate_content([prompt, *parts])
+                call_times.append(time.perf_counter() - start_time)
+                prompt_tokens = response.usage_metadata.prompt_token_count
+
+        rows.append({
+            "input": os.path.basename(input_path),
+            "mode": mode,
+            "frames": len(frames),
+            "images": len(parts),
+            "payloadBytes": sum(len(part["data"]) for part in parts),
+            "buildMs": round(statistics.median(build_times) * 1000, 1),
+            "promptTokens": prompt_tokens,
+            "callMedianSec": round(statistics.median(call_times), 2) if call_times else None,
+        })
+    return rows
+
+def print_table(rows: list) -> None:
+    header = (
+        f"{'input':<28} {'mode':<7} {'images':>6} {'payload(bytes)':>15} {'build(ms)':>10} "
+        f"{'tokens':>7} {'call(s)':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        tokens = row["promptTokens"] if row["promptTokens"] is not None else "-"
+        call_sec = f"{row['callMedianSec']:.2f}" if row["callMedianSec"] is not None else "-"
+        print(
+            f"{row['input']:<28} {row['mode']:<7} {row['images']:>6} {row['payloadBytes']:>15,} "
+            f"{row['buildMs']:>10.1f} {tokens:>7} {call_sec:>8}"
+        )
+
+def run(args: argparse.Namespace) -> None:
+    if args.call and not main.GEMINI_API_KEY:
+        raise SystemExit("--call requires GEMINI_API_KEY")
+    print(f"Model: {main.GEMINI_MODEL_NAME}, max frames: {main.MAX_FRAMES_FOR_GEMINI}")
+
+    rows = []
+    for input_path in args.inputs:
+        rows.extend(benchmark_clip(input_path, args.start, args.end, args.runs, args.call))
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="フレームごとの送信とコンタクトシートの送信を比較します。")
+    parser.add_argument("inputs", nargs="+", help="入力動画ファイル")
+    parser.add_argument("--start", type=float, default=0.0, help="分析範囲の開始（秒）")
+    parser.add_argument("--end", type=float, default=5.0, help="分析範囲の終了（秒）")
+    parser.add_argument("--runs", type=int, default=3, help="モードごとの実行回数（中央値を表示）")
+    parser.add_argument("--call", action="store_true", help="実際にGeminiを呼んでトークン数と応答時間を測る")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    run(parser.parse_args())
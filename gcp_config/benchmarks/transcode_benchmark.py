@@ -0,0 +1,97 @@
+"""
+セグメント並列トランスコードのベンチマーク。
+
+同じ入力を optimize_video_ffmpeg の単一プロセス（-threads 0）モードと
+キーフレーム分割の並列モードで処理し、処理時間と出力サイズを比較する。
+Cloud Runと同じCPU数で比べるには、コンテナのCPUを制限して実行する
+（例: docker run --cpus=2 ...）。
+
+使い方:
+    python benchmarks/transcode_benchmark.py input1.mp4 [input2.mp4 ...] --runs 3
+    python benchmarks/transcode_benchmark.py input.mp4 --segments 4 --json result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# main.py をインポートする前に、ストレージをGCSに繋がないインメモリにしておく
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+MODES = ("single", "segmented")
+
+async def benchmark_file(input_path: str, runs: int) -> list:
+    media_info = await main.probe_media_info(input_path)
+    if media_info is None:
+        raise RuntimeError(f"Could not probe {input_path}")
+
+    rows = []
+    for mode in MODES:
+        elapsed = []
+        result = None
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as work_dir:
+                output_path = os.path.join(work_dir, "optimized.mp4")
+                start_time = time.perf_counter()
+                result = await main.optimize_video_ffmpeg(
+                    input_path, output_path,
+                    media_info=media_info,
+                    allow_remux=False,  # 再エンコードの速度を比べるため常にトランスコードする
+                    transcode_mode=mode
+                )
+                elapsed.append(time.perf_counter() - start_time)
+        rows.append({
+            "input": os.path.basename(input_path),
+            "mode": mode,
+            "segments": result["segments"],
+            "runs": runs,
+            "medianSec": round(statistics.median(elapsed), 2),
+            "minSec": round(min(elapsed), 2),
+            "inputBytes": result["originalSize"],
+            "outputBytes": result["optimizedSize"],
+            "outputDurationSec": result["optimizedDuration"],
+        })
+    return rows
+
+def print_table(rows: list) -> None:
+    header = f"{'input':<28} {'mode':<10} {'seg':>3} {'median(s)':>10} {'min(s)':>8} {'output(bytes)':>14} {'vs single':>10}"
+    print(header)
+    print("-" * len(header))
+    baselines = {row["input"]: row for row in rows if row["mode"] == "single"}
+    for row in rows:
+        baseline = baselines.get(row["input"])
+        speedup = f"{baseline['medianSec'] / row['medianSec']:.2f}x" if baseline and row["medianSec"] else "-"
+        print(
+            f"{row['input']:<28} {row['mode']:<10} {row['segments']:>3} {row['medianSec']:>10.2f} "
+            f"{row['minSec']:>8.2f} {row['outputBytes']:>14,} {speedup:>10}"
+        )
+
+async def run(args: argparse.Namespace) -> None:
+    if args.segments:
+        main.TRANSCODE_SEGMENTS = args.segments
+    print(f"CPU quota: {main.get_cpu_quota()}, segments: {main.TRANSCODE_SEGMENTS or 'auto'}")
+
+    rows = []
+    for input_path in args.inputs:
+        rows.extend(await benchmark_file(input_path, args.runs))
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="単一プロセスとセグメント並列のトランスコードを比較します。")
+    parser.add_argument("inputs", nargs="+", help="入力動画ファイル")
+    parser.add_argument("--runs", type=int, default=3, help="モードごとの実行回数（中央値を表示）")
+    parser.add_argument("--segments", type=int, default=0, help="分割数（0ならCPUクォータに合わせる）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    asyncio.run(run(parser.parse_args()))
@@ -1,28 +1,45 @@
 from fastapi import FastAPI, UploadFile, HTTPException, Header, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
-from fastapi.responses import FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse, RedirectResponse
 from pydantic import BaseModel
 import os
 import uuid
-from typing import Optional, List, Dict, Any, Tuple
-from moviepy.editor import VideoFileClip
+from typing import Optional, List, Dict, Any, Tuple, NamedTuple, Callable, Union
 import cv2
 import numpy as np
 from dotenv import load_dotenv
 import google.generativeai as genai
 import chromadb
 from chromadb.config import Settings
-from PIL import Image
 from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import requests
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import Chroma
 from functools import lru_cache
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 import subprocess
 import base64
 from pathlib import Path
 import logging
+import asyncio
+import hashlib
+import shutil
+import threading
+import time
+import hmac
+import json
+import mimetypes
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from abc import ABC, abstractmethod
+from urllib.parse import quote, urlencode
 
 # Load environment variables
 load_dotenv()
@@ -33,6 +50,14 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 CHROMA_DB_URL = os.getenv("CHROMA_DB_URL")
 CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "bouldering_advice")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/embedding-001")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-lite")
+GEMINI_WARMUP = os.getenv("GEMINI_WARMUP", "true").lower() == "true"  # 起動時にAPIへの接続まで済ませる
+# Gemini分析結果のキャッシュ。プロンプトを変えたらANALYSIS_PROMPT_VERSIONを上げて古い結果を使わないようにする
+ANALYSIS_PROMPT_VERSION = "2"
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "512"))
+ANALYSIS_CACHE_TTL_SEC = int(os.getenv("ANALYSIS_CACHE_TTL_SEC", str(24 * 60 * 60)))
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "")  # 空ならディスクには保存しない
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 MEMORY_LIMIT = os.getenv("MEMORY_LIMIT", "4096M")
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "900"))
@@ -109,12 +134,114 @@ app.add_middleware(
 # Application constants
 ANALYSIS_INTERVAL_SEC = 0.5
 MAX_FRAMES_FOR_GEMINI = 10
+# フレーム抽出: "sparse"は使うフレームだけをデコード、"full"は従来通り範囲内を全デコード
+FRAME_SAMPLING_MODE = os.getenv("FRAME_SAMPLING_MODE", "sparse")
+# スパース抽出でgrab()ではなくシークに切り替える距離（秒）
+FRAME_SEEK_THRESHOLD_SEC = float(os.getenv("FRAME_SEEK_THRESHOLD_SEC", "1.0"))
+# フレーム抽出バックエンド: "opencv"（cv2.VideoCapture）または "ffmpeg"（rawvideoパイプ）
+FRAME_EXTRACTION_BACKEND = os.getenv("FRAME_EXTRACTION_BACKEND", "opencv")
+# ffmpegバックエンドで出力するフレームサイズ（Geminiに渡す解像度）
+GEMINI_FRAME_WIDTH = int(os.getenv("GEMINI_FRAME_WIDTH", "768"))
+GEMINI_FRAME_HEIGHT = int(os.getenv("GEMINI_FRAME_HEIGHT", "432"))
+# Geminiに渡す画像: 長辺を縮小してJPEGにし、1リクエストの予算（バイト数・推定トークン数）に収める
+GEMINI_IMAGE_MAX_EDGE = int(os.getenv("GEMINI_IMAGE_MAX_EDGE", "768"))
+GEMINI_IMAGE_MIN_EDGE = int(os.getenv("GEMINI_IMAGE_MIN_EDGE", "384"))
+GEMINI_IMAGE_JPEG_QUALITY = int(os.getenv("GEMINI_IMAGE_JPEG_QUALITY", "85"))
+GEMINI_IMAGE_MIN_QUALITY = int(os.getenv("GEMINI_IMAGE_MIN_QUALITY", "50"))
+GEMINI_IMAGE_BYTE_BUDGET = int(os.getenv("GEMINI_IMAGE_BYTE_BUDGET", str(1024 * 1024)))
+GEMINI_IMAGE_TOKEN_BUDGET = int(os.getenv("GEMINI_IMAGE_TOKEN_BUDGET", "0"))  # 0: 制限なし
+GEMINI_IMAGE_ENCODE_WORKERS = int(os.getenv("GEMINI_IMAGE_ENCODE_WORKERS", "4"))
+# "frames": フレームを1枚ずつ送る / "grid": 1枚のコンタクトシート（番号付きのグリッド画像）にまとめて送る
+GEMINI_IMAGE_MODE = os.getenv("GEMINI_IMAGE_MODE", "frames")
+GEMINI_CONTACT_SHEET_CELL_WIDTH = int(os.getenv("GEMINI_CONTACT_SHEET_CELL_WIDTH", "384"))
 DEFAULT_RETRIEVAL_K = 3
 UPLOAD_DIR = Path("/tmp/videos")
 
 # Ensure upload directory exists
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+def parse_size_bytes(value: str, default: int) -> int:
+    """"4096M" / "100MB" / "1Gi" のようなサイズ表記をバイト数に変換する"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = (value or "").strip().upper().replace("IB", "").replace("B", "")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        return default
+
+# ストレージバックエンド: "gcs" / "local"（LOCAL_STORAGE_DIR配下）/ "memory"（プロセス内）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+LOCAL_STORAGE_DIR = Path(os.getenv("LOCAL_STORAGE_DIR", "/tmp/local_storage"))
+# local/memoryバックエンドの署名URLのベースURLと署名鍵（未指定ならプロセスごとに生成）
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL", "http://localhost:8000")
+LOCAL_STORAGE_SIGNING_KEY = (os.getenv("LOCAL_STORAGE_SIGNING_KEY") or uuid.uuid4().hex).encode("utf-8")
+
+# 同時に実行するffmpeg/ffprobeプロセス数の上限
+FFMPEG_MAX_CONCURRENCY = int(os.getenv("FFMPEG_MAX_CONCURRENCY", "2"))
+
+# 最適化後の配信条件。これを満たすH.264入力は再エンコードせずストリームコピーする
+OPTIMIZED_WIDTH = 1280
+OPTIMIZED_HEIGHT = 720
+OPTIMIZED_FPS = 30
+OPTIMIZE_PRESET = "fast"
+REMUX_FAST_PATH = os.getenv("REMUX_FAST_PATH", "true").lower() == "true"
+# "single": 1プロセスでエンコード / "segmented": キーフレームで分割して並列エンコード
+TRANSCODE_MODE = os.getenv("TRANSCODE_MODE", "single")
+# 分割数（0ならコンテナのCPUクォータに合わせる）と、1区間の最短長
+TRANSCODE_SEGMENTS = int(os.getenv("TRANSCODE_SEGMENTS", "0"))
+SEGMENT_MIN_DURATION_SEC = float(os.getenv("SEGMENT_MIN_DURATION_SEC", "3.0"))
+# 取り込み時に作る分析用プロキシ（低解像度・短GOP）。範囲分析はこちらをデコードする
+ANALYSIS_PROXY_ENABLED = os.getenv("ANALYSIS_PROXY_ENABLED", "true").lower() == "true"
+ANALYSIS_PROXY_WIDTH = 854
+ANALYSIS_PROXY_HEIGHT = 480
+ANALYSIS_PROXY_GOP_SEC = float(os.getenv("ANALYSIS_PROXY_GOP_SEC", "0.5"))
+# 取り込み時に一定間隔で抜き出してJPEGで保存しておくフレーム（分析時は必要な範囲だけ読む）
+FRAME_STORE_ENABLED = os.getenv("FRAME_STORE_ENABLED", "true").lower() == "true"
+FRAME_STORE_FPS = int(os.getenv("FRAME_STORE_FPS", "4"))
+FRAME_STORE_JPEG_QSCALE = int(os.getenv("FRAME_STORE_JPEG_QSCALE", "3"))  # ffmpeg -q:v（2〜31、小さいほど高画質）
+# プレビュー用のHLS（fMP4）。低ビットレートのプレビューと分析用の2レンディションを作る
+HLS_ENABLED = os.getenv("HLS_ENABLED", "false").lower() == "true"
+HLS_SEGMENT_SEC = float(os.getenv("HLS_SEGMENT_SEC", "2"))
+HLS_PREVIEW_WIDTH = 640
+HLS_PREVIEW_HEIGHT = 360
+HLS_PREVIEW_BITRATE = os.getenv("HLS_PREVIEW_BITRATE", "400k")
+# /upload-full-video で受信データを元ファイルとして保存せず、そのままffmpegの標準入力へ流す
+STREAMING_UPLOAD = os.getenv("STREAMING_UPLOAD", "false").lower() == "true"
+# パイプで読めるか（moovが先頭側にあるか）を判定するために先読みするバイト数
+STREAMING_UPLOAD_PROBE_BYTES = 256 * 1024
+
+# メディア情報（ffprobe結果）のプロセス内キャッシュの件数上限
+MEDIA_INFO_CACHE_SIZE = int(os.getenv("MEDIA_INFO_CACHE_SIZE", "256"))
+
+# GCSクライアントのHTTPコネクションプールサイズ（containerConcurrency + ストリーミング分の余裕）
+GCS_HTTP_POOL_SIZE = int(os.getenv("GCS_HTTP_POOL_SIZE", "32"))
+
+# GCS動画のローカルキャッシュ（Cloud Runの/tmpはメモリ上なので、既定はメモリ上限の1/4）
+VIDEO_CACHE_DIR = Path(os.getenv("VIDEO_CACHE_DIR", "/tmp/video_cache"))
+VIDEO_CACHE_MAX_BYTES = int(os.getenv(
+    "VIDEO_CACHE_MAX_BYTES",
+    str(parse_size_bytes(MEMORY_LIMIT, 4096 * 1024 * 1024) // 4)
+))
+# /video/{filename} のストリーミング単位（GCSへの範囲リクエスト1回分）
+VIDEO_STREAM_CHUNK_SIZE = int(os.getenv("VIDEO_STREAM_CHUNK_SIZE", str(1024 * 1024)))
+# /video/{filename} の既定モード: "proxy"（このサービスが中継）/ "redirect"（署名URLへ302）/ "json"（署名URLを返す）
+VIDEO_SERVE_MODE = os.getenv("VIDEO_SERVE_MODE", "proxy")
+VIDEO_SIGNED_URL_TTL_SEC = int(os.getenv("VIDEO_SIGNED_URL_TTL_SEC", "900"))
+# 有効期限のこの秒数前になったら署名URLを作り直す
+VIDEO_SIGNED_URL_REFRESH_MARGIN_SEC = int(os.getenv("VIDEO_SIGNED_URL_REFRESH_MARGIN_SEC", "120"))
+# バックグラウンドジョブの保存先・並列数・完了済みジョブの保持期間
+JOBS_DIR = Path(os.getenv("JOBS_DIR", "/tmp/jobs"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+JOB_RETENTION_SEC = int(os.getenv("JOB_RETENTION_SEC", str(24 * 60 * 60)))
+# 同じ内容の動画の再アップロードは最適化せずに前回の結果を返す。
+# 期限はバケットのライフサイクルルール（最適化済み動画の削除までの期間）に合わせる
+DEDUPE_ENABLED = os.getenv("DEDUPE_ENABLED", "true").lower() == "true"
+DEDUPE_TTL_SEC = int(os.getenv("DEDUPE_TTL_SEC", str(7 * 24 * 60 * 60)))
+# SSEで進捗がない間に送るキープアライブの間隔
+JOB_EVENTS_KEEPALIVE_SEC = float(os.getenv("JOB_EVENTS_KEEPALIVE_SEC", "15"))
+
 class AnalysisSettings(BaseModel):
     problemType: str
     crux: str
@@ -138,12 +265,24 @@ class VideoMetadata(BaseModel):
     optimizedSize: int
     optimizedDuration: float
     compressionRatio: float
+    processingPath: Optional[str] = None  # "remux"（ストリームコピー） or "transcode"
+
+class MediaInfo(BaseModel):
+    """ffprobe 1回分の結果。アップロード時にオブジェクトメタデータとして保存し、以降はそれを使う"""
+    duration: float
+    fps: Optional[float] = None
+    width: int = 0
+    height: int = 0
+    codec: Optional[str] = None
+    pixFmt: Optional[str] = None
+    keyframes: List[float] = []  # キーフレームの時刻（秒）
 
 class FullVideoUploadResponse(BaseModel):
     gcsBlobName: str
     videoId: str
     metadata: VideoMetadata
     previewUrl: str
+    hlsManifestUrl: Optional[str] = None  # HLSを作った場合のマスタープレイリスト
 
 class RangeAnalysisSettings(BaseModel):
     problemType: str
@@ -162,10 +301,33 @@ class SignedUrlResponse(BaseModel):
     gcsBlobName: str
     videoId: str
 
+class SignedVideoUrlResponse(BaseModel):
+    url: str
+    expiresAt: str
+
 class VideoProcessRequest(BaseModel):
     gcsBlobName: str
     originalFileName: str
 
+# バックグラウンドジョブ関連のモデル
+class JobSubmitResponse(BaseModel):
+    jobId: str
+    state: str
+    statusUrl: str
+    eventsUrl: str
+
+class JobStatusResponse(BaseModel):
+    jobId: str
+    kind: str
+    state: str  # queued / running / succeeded / failed
+    stage: Optional[str] = None
+    progress: float
+    detail: Dict[str, Any] = {}
+    createdAt: str
+    updatedAt: str
+    result: Optional[Union[FullVideoUploadResponse, AnalysisResponse]] = None
+    error: Optional[str] = None
+
 # ログ関連のモデル
 class LogEntry(BaseModel):
     timestamp: str
@@ -207,8 +369,26 @@ except RuntimeError as e:
     # 本番環境では sys.exit(1) を使用することを検討
     pass
 
-def extract_frames(video_path: str, start_sec: float, end_sec: float, interval_sec: float = ANALYSIS_INTERVAL_SEC) -> list:
+def select_sample_indices(count: int, max_frames: int = MAX_FRAMES_FOR_GEMINI) -> List[int]:
+    """count個の候補からmax_frames個を等間隔に選ぶ（analyze_and_generate_adviceと同じ選び方）"""
+    if count <= 0:
+        return []
+    num_frames = min(count, max_frames)
+    return [int(i) for i in np.linspace(0, count - 1, num_frames, dtype=int)]
+
+def extract_frames(
+    video_path: str,
+    start_sec: float,
+    end_sec: float,
+    interval_sec: float = ANALYSIS_INTERVAL_SEC,
+    max_frames: Optional[int] = None
+) -> Tuple[list, List[float]]:
+    """
+    指定範囲からinterval_sec間隔でフレームを抽出する。(フレーム, 各フレームの時刻（秒）) を返す。
+    max_framesを指定するとスパースモードになり、実際に使うフレームだけをデコードする。
+    """
     frames = []
+    frame_times = []
     cap = cv2.VideoCapture(video_path)
     
     if not cap.isOpened():
@@ -219,6 +399,14 @@ def extract_frames(video_path: str, start_sec: float, end_sec: float, interval_s
     end_frame = int(end_sec * fps)
     interval_frames = max(1, int(interval_sec * fps))
     
+    if max_frames is not None:
+        # 対象フレーム番号を先に確定させ、そのフレームだけをretrieve()する
+        candidate_frames = list(range(start_frame, end_frame + 1, interval_frames))
+        target_frames = [candidate_frames[i] for i in select_sample_indices(len(candidate_frames), max_frames)]
+        frames = _read_target_frames(cap, target_frames, fps)
+        cap.release()
+        return frames, [frame / fps for frame in target_frames[:len(frames)]]
+    
     cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
     
     current_frame = start_frame
@@ -229,12 +417,684 @@ def extract_frames(video_path: str, start_sec: float, end_sec: float, interval_s
             
         if (current_frame - start_frame) % interval_frames == 0:
             frames.append(frame)
+            frame_times.append(current_frame / fps)
             
         current_frame += 1
         
     cap.release()
+    return frames, frame_times
+
+def extract_analysis_frames(video_path: str, start_sec: float, end_sec: float) -> Tuple[list, List[float]]:
+    """分析用フレームを設定されたバックエンドとサンプリングモードで抽出する。(フレーム, 各フレームの時刻（秒）) を返す"""
+    if FRAME_EXTRACTION_BACKEND == "ffmpeg":
+        try:
+            return extract_frames_ffmpeg(video_path, start_sec, end_sec)
+        except Exception as e:
+            logger.warning(f"FFmpeg frame extraction failed, falling back to OpenCV: {e}")
+
+    if FRAME_SAMPLING_MODE == "sparse":
+        return extract_frames(video_path, start_sec, end_sec, max_frames=MAX_FRAMES_FOR_GEMINI)
+    return extract_frames(video_path, start_sec, end_sec)
+
+def extract_frames_ffmpeg(
+    video_path: str,
+    start_sec: float,
+    end_sec: float,
+    interval_sec: float = ANALYSIS_INTERVAL_SEC,
+    max_frames: int = MAX_FRAMES_FOR_GEMINI,
+    width: int = GEMINI_FRAME_WIDTH,
+    height: int = GEMINI_FRAME_HEIGHT
+) -> Tuple[list, List[float]]:
+    """
+    FFmpegでデコード・縮小したフレームをrawvideo(bgr24)として受け取り、
+    事前確保した(N, H, W, 3)のuint8配列へreadintoで直接書き込む。
+    戻り値はその配列の各フレームのビューと各フレームの時刻（extract_framesと同じ形）。
+    """
+    if end_sec < start_sec:
+        return [], []
+
+    # extract_framesと同じinterval_sec間隔の候補から、使うフレームだけを選ぶ
+    candidate_count = int((end_sec - start_sec) / interval_sec) + 1
+    selected = select_sample_indices(candidate_count, max_frames)
+    num_frames = len(selected)
+    select_expr = "+".join(f"eq(n,{i})" for i in selected)
+
+    cmd = [
+        'ffmpeg', '-v', 'error', '-nostdin',
+        '-ss', f"{start_sec:.3f}",   # 入力側シーク
+        '-t', f"{(candidate_count - 0.5) * interval_sec:.3f}",
+        '-i', video_path,
+        '-an',
+        '-vf', (
+            f"fps={1.0 / interval_sec:.6f},"
+            f"select='{select_expr}',"
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2"
+        ),
+        '-fps_mode', 'vfr',
+        '-frames:v', str(num_frames),
+        '-f', 'rawvideo',
+        '-pix_fmt', 'bgr24',
+        'pipe:1'
+    ]
+
+    buffer = np.empty((num_frames, height, width, 3), dtype=np.uint8)
+    view = memoryview(buffer).cast('B')
+    total_bytes = view.nbytes
+    offset = 0
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+    # readinto()はブロックするので、期限を過ぎたらタイマーでffmpegを止めてパイプを閉じさせる
+    timed_out = threading.Event()
+
+    def kill_on_timeout() -> None:
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(60, kill_on_timeout)
+    timer.start()
+    try:
+        while offset < total_bytes:
+            read = process.stdout.readinto(view[offset:])
+            if not read:
+                break
+            offset += read
+        _, stderr = process.communicate()
+    finally:
+        timer.cancel()
+        view.release()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    if timed_out.is_set():
+        raise Exception("FFmpeg frame extraction timed out")
+    if process.returncode != 0:
+        raise Exception(f"FFmpeg frame extraction failed (code {process.returncode}): {stderr.decode(errors='replace')}")
+
+    frame_count = offset // (width * height * 3)
+    return list(buffer[:frame_count]), [start_sec + i * interval_sec for i in selected[:frame_count]]
+
+def _read_target_frames(cap: cv2.VideoCapture, target_frames: List[int], fps: float) -> list:
+    """
+    target_frames（昇順のフレーム番号）だけを読み出す。
+    近いフレームへはgrab()で進み（色変換・コピーなし）、遠いフレームへはシークする。
+    """
+    frames = []
+    # これ以上離れている場合はgrab()で進むよりキーフレームからシークした方が安い
+    seek_threshold = max(1, int(FRAME_SEEK_THRESHOLD_SEC * fps))
+    position = None  # 次にgrab()で得られるフレーム番号
+
+    for target in target_frames:
+        if position is None or target < position or target - position > seek_threshold:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            position = target
+
+        while position < target:
+            if not cap.grab():
+                return frames
+            position += 1
+
+        if not cap.grab():
+            break
+        position += 1
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        frames.append(frame)
+
     return frames
 
+class LatencyStats:
+    """操作ごとのレイテンシ（件数・平均・最大・直近サンプルのp95）を記録する"""
+
+    def __init__(self, sample_size: int = 200):
+        self._lock = threading.Lock()
+        self._sample_size = sample_size
+        self._operations: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, operation: str, seconds: float) -> None:
+        with self._lock:
+            op = self._operations.setdefault(
+                operation,
+                {"count": 0, "totalSec": 0.0, "maxSec": 0.0, "samples": deque(maxlen=self._sample_size)}
+            )
+            op["count"] += 1
+            op["totalSec"] += seconds
+            op["maxSec"] = max(op["maxSec"], seconds)
+            op["samples"].append(seconds)
+
+    @contextmanager
+    def track(self, operation: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(operation, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for operation, op in self._operations.items():
+                samples = sorted(op["samples"])
+                result[operation] = {
+                    "count": op["count"],
+                    "avgMs": round(op["totalSec"] / op["count"] * 1000, 1),
+                    "p95Ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+                    "maxMs": round(op["maxSec"] * 1000, 1)
+                }
+            return result
+
+storage_latency_stats = LatencyStats()
+
+@lru_cache(maxsize=1)
+def get_storage_client() -> storage.Client:
+    """プロセス全体で共有するGCSクライアント（認証情報とHTTPセッションを使い回す）"""
+    client = storage.Client()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+    client._http.mount("https://", adapter)
+    logger.info(f"GCS client initialized (pool size: {GCS_HTTP_POOL_SIZE})")
+    return client
+
+@lru_cache(maxsize=1)
+def get_gcs_bucket() -> storage.Bucket:
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+    return get_storage_client().bucket(GCS_BUCKET_NAME)
+
+class StoredBlob:
+    """ローカル/インメモリのバックエンドが返すblob情報（storage.Blobと同じ属性名）"""
+
+    def __init__(self, name: str, size: int, generation: int, content_type: Optional[str],
+                 updated: datetime, md5_hash: Optional[str] = None, metadata: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.size = size
+        self.generation = generation
+        self.etag = f"{generation:x}-{size:x}"
+        self.content_type = content_type
+        self.updated = updated
+        self.md5_hash = md5_hash
+        self.metadata = metadata or {}
+
+class StorageBackend(ABC):
+    """
+    動画ストレージの共通インターフェース。
+    get_blob()はメタデータ（name, size, generation, etag, content_type, updated, md5_hash）付きの
+    オブジェクトを返し、存在しなければNoneを返す。
+    generationを指定した読み出しで世代が一致しなければPreconditionFailedを送出する（GCSと同じ）。
+    """
+    name = "base"
+
+    def warm_up(self) -> None:
+        pass
+
+    @abstractmethod
+    def get_blob(self, blob_name: str):
+        ...
+
+    def exists(self, blob_name: str) -> bool:
+        return self.get_blob(blob_name) is not None
+
+    @abstractmethod
+    def download_to_file(self, blob_name: str, local_path: str, generation: Optional[int] = None) -> bool:
+        """blobをlocal_pathにダウンロードする。存在しなければFalse"""
+
+    @abstractmethod
+    def read_range(self, blob_name: str, start: int, end: int, generation: Optional[int] = None) -> bytes:
+        """[start, end]（endを含む）のバイト列を取得する"""
+
+    @abstractmethod
+    def upload_file(self, blob_name: str, local_path: str, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        """metadata はカスタムメタデータとして保存され、get_blob().metadata で読める"""
+
+    @abstractmethod
+    def upload_bytes(self, blob_name: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        ...
+
+    @abstractmethod
+    def upload_fileobj(self, blob_name: str, fileobj, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        """ファイルオブジェクトの先頭から末尾までをアップロードする"""
+
+    @abstractmethod
+    def delete(self, blob_name: str) -> bool:
+        """blobを削除する。存在しなければFalse"""
+
+    @abstractmethod
+    def signed_url(self, blob_name: str, method: str, expiration: timedelta, **kwargs) -> str:
+        ...
+
+class GCSStorageBackend(StorageBackend):
+    """
+    GCSバックエンド。共有クライアントを使い、
+    存在確認+ダウンロードのような往復は1回のリクエストにまとめ、404はNone/Falseで返す。
+    """
+    name = "gcs"
+
+    def warm_up(self) -> None:
+        get_gcs_bucket()
+
+    def get_blob(self, blob_name: str) -> Optional[storage.Blob]:
+        with storage_latency_stats.track("get_metadata"):
+            return get_gcs_bucket().get_blob(blob_name)
+
+    def download_to_file(self, blob_name: str, local_path: str, generation: Optional[int] = None) -> bool:
+        blob = get_gcs_bucket().blob(blob_name)
+        try:
+            with storage_latency_stats.track("download"):
+                blob.download_to_filename(local_path, if_generation_match=generation)
+            return True
+        except NotFound:
+            # 失敗時に空ファイルが残ることがあるので削除する
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            return False
+
+    def read_range(self, blob_name: str, start: int, end: int, generation: Optional[int] = None) -> bytes:
+        blob = get_gcs_bucket().blob(blob_name)
+        with storage_latency_stats.track("read_range"):
+            return blob.download_as_bytes(start=start, end=end, if_generation_match=generation)
+
+    def upload_file(self, blob_name: str, local_path: str, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        blob = get_gcs_bucket().blob(blob_name)
+        blob.metadata = metadata
+        with storage_latency_stats.track("upload"):
+            blob.upload_from_filename(local_path, content_type=content_type)
+
+    def upload_bytes(self, blob_name: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        blob = get_gcs_bucket().blob(blob_name)
+        blob.metadata = metadata
+        with storage_latency_stats.track("upload"):
+            blob.upload_from_string(data, content_type=content_type)
+
+    def upload_fileobj(self, blob_name: str, fileobj, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        blob = get_gcs_bucket().blob(blob_name)
+        blob.metadata = metadata
+        with storage_latency_stats.track("upload"):
+            blob.upload_from_file(fileobj, rewind=True, content_type=content_type)
+
+    def delete(self, blob_name: str) -> bool:
+        try:
+            with storage_latency_stats.track("delete"):
+                get_gcs_bucket().blob(blob_name).delete()
+            return True
+        except NotFound:
+            return False
+
+    def signed_url(self, blob_name: str, method: str, expiration: timedelta, **kwargs) -> str:
+        blob = get_gcs_bucket().blob(blob_name)
+        with storage_latency_stats.track(f"sign_{method.lower()}"):
+            return blob.generate_signed_url(version="v4", expiration=expiration, method=method, **kwargs)
+
+class _LocallySignedUrlMixin:
+    """ローカル/インメモリ用の署名URL（/storage/{blob_name} をHMACで保護する）"""
+
+    def signed_url(self, blob_name: str, method: str, expiration: timedelta, **kwargs) -> str:
+        with storage_latency_stats.track(f"sign_{method.lower()}"):
+            expires = int(time.time() + expiration.total_seconds())
+            signature = sign_local_storage_request(method, blob_name, expires)
+            query = urlencode({"method": method.upper(), "expires": expires, "signature": signature})
+            return f"{LOCAL_STORAGE_BASE_URL}/storage/{quote(blob_name)}?{query}"
+
+class LocalStorageBackend(_LocallySignedUrlMixin, StorageBackend):
+    """
+    ローカルファイルシステムのバックエンド（1台のLinuxでのベンチマーク・負荷試験用）。
+    blobはroot配下に保存し、content_type等は.meta配下のJSONに保存する。
+    """
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, blob_name: str) -> Path:
+        path = (self.root / blob_name).resolve()
+        if self.root.resolve() not in path.parents:
+            raise HTTPException(status_code=400, detail="Invalid blob name")
+        return path
+
+    def _meta_path(self, blob_name: str) -> Path:
+        return self.root / ".meta" / f"{blob_name}.json"
+
+    def get_blob(self, blob_name: str) -> Optional[StoredBlob]:
+        with storage_latency_stats.track("get_metadata"):
+            path = self._path(blob_name)
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return None
+            try:
+                meta = json.loads(self._meta_path(blob_name).read_text())
+            except (FileNotFoundError, ValueError):
+                meta = {}
+            return StoredBlob(
+                name=blob_name,
+                size=stat.st_size,
+                generation=stat.st_mtime_ns,
+                content_type=meta.get("contentType") or mimetypes.guess_type(blob_name)[0],
+                updated=datetime.utcfromtimestamp(stat.st_mtime),
+                md5_hash=meta.get("md5Hash"),
+                metadata=meta.get("metadata")
+            )
+
+    def _check_generation(self, blob_name: str, generation: Optional[int]) -> None:
+        if generation is not None and self._path(blob_name).stat().st_mtime_ns != generation:
+            raise PreconditionFailed(f"Generation mismatch for {blob_name}")
+
+    def download_to_file(self, blob_name: str, local_path: str, generation: Optional[int] = None) -> bool:
+        with storage_latency_stats.track("download"):
+            try:
+                self._check_generation(blob_name, generation)
+                shutil.copyfile(self._path(blob_name), local_path)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def read_range(self, blob_name: str, start: int, end: int, generation: Optional[int] = None) -> bytes:
+        with storage_latency_stats.track("read_range"):
+            self._check_generation(blob_name, generation)
+            with open(self._path(blob_name), "rb") as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+
+    def _write_meta(self, blob_name: str, content_type: str, md5_digest: bytes, metadata: Optional[Dict[str, str]]) -> None:
+        meta_path = self._meta_path(blob_name)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        meta_path.write_text(json.dumps({
+            "contentType": content_type,
+            "md5Hash": base64.b64encode(md5_digest).decode("ascii"),
+            "metadata": metadata or {}
+        }))
+
+    def upload_file(self, blob_name: str, local_path: str, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        with open(local_path, "rb") as src_file:
+            self.upload_fileobj(blob_name, src_file, content_type, metadata)
+
+    def upload_fileobj(self, blob_name: str, fileobj, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        with storage_latency_stats.track("upload"):
+            path = self._path(blob_name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            md5 = hashlib.md5()
+            part_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+            fileobj.seek(0)
+            with open(part_path, "wb") as dst_file:
+                while chunk := fileobj.read(1024 * 1024):
+                    md5.update(chunk)
+                    dst_file.write(chunk)
+            os.replace(part_path, path)
+            self._write_meta(blob_name, content_type, md5.digest(), metadata)
+
+    def upload_bytes(self, blob_name: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        with storage_latency_stats.track("upload"):
+            path = self._path(blob_name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            part_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+            part_path.write_bytes(data)
+            os.replace(part_path, path)
+            self._write_meta(blob_name, content_type, hashlib.md5(data).digest(), metadata)
+
+    def delete(self, blob_name: str) -> bool:
+        with storage_latency_stats.track("delete"):
+            try:
+                self._path(blob_name).unlink()
+            except FileNotFoundError:
+                return False
+            self._meta_path(blob_name).unlink(missing_ok=True)
+            return True
+
+class InMemoryStorageBackend(_LocallySignedUrlMixin, StorageBackend):
+    """
+    インメモリのバックエンド（テスト・負荷試験用）。
+    upload_bytes()は受け取ったbytesをコピーせずにそのまま保持する。
+    """
+    name = "memory"
+
+    def __init__(self):
+        self._objects: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def _get(self, blob_name: str, generation: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            obj = self._objects.get(blob_name)
+        if obj is not None and generation is not None and obj["generation"] != generation:
+            raise PreconditionFailed(f"Generation mismatch for {blob_name}")
+        return obj
+
+    def get_blob(self, blob_name: str) -> Optional[StoredBlob]:
+        obj = self._get(blob_name)
+        if obj is None:
+            return None
+        return StoredBlob(
+            name=blob_name,
+            size=len(obj["data"]),
+            generation=obj["generation"],
+            content_type=obj["contentType"],
+            updated=obj["updated"],
+            md5_hash=obj["md5Hash"],
+            metadata=obj["metadata"]
+        )
+
+    def download_to_file(self, blob_name: str, local_path: str, generation: Optional[int] = None) -> bool:
+        with storage_latency_stats.track("download"):
+            obj = self._get(blob_name, generation)
+            if obj is None:
+                return False
+            with open(local_path, "wb") as f:
+                f.write(obj["data"])
+            return True
+
+    def read_range(self, blob_name: str, start: int, end: int, generation: Optional[int] = None) -> bytes:
+        with storage_latency_stats.track("read_range"):
+            obj = self._get(blob_name, generation)
+            if obj is None:
+                raise FileNotFoundError(blob_name)
+            return bytes(memoryview(obj["data"])[start:end + 1])
+
+    def upload_bytes(self, blob_name: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        with storage_latency_stats.track("upload"):
+            with self._lock:
+                self._generation += 1
+                self._objects[blob_name] = {
+                    "data": data,
+                    "generation": self._generation,
+                    "contentType": content_type,
+                    "updated": datetime.utcnow(),
+                    "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode("ascii"),
+                    "metadata": dict(metadata or {})
+                }
+
+    def upload_file(self, blob_name: str, local_path: str, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        with open(local_path, "rb") as f:
+            self.upload_fileobj(blob_name, f, content_type, metadata)
+
+    def upload_fileobj(self, blob_name: str, fileobj, content_type: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        fileobj.seek(0)
+        self.upload_bytes(blob_name, fileobj.read(), content_type, metadata)
+
+    def delete(self, blob_name: str) -> bool:
+        with self._lock:
+            return self._objects.pop(blob_name, None) is not None
+
+def sign_local_storage_request(method: str, blob_name: str, expires: int) -> str:
+    message = f"{method.upper()}\n{blob_name}\n{expires}".encode("utf-8")
+    return hmac.new(LOCAL_STORAGE_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+def create_storage_backend(backend_name: str) -> StorageBackend:
+    if backend_name == "gcs":
+        return GCSStorageBackend()
+    if backend_name == "local":
+        return LocalStorageBackend(LOCAL_STORAGE_DIR)
+    if backend_name == "memory":
+        return InMemoryStorageBackend()
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend_name}")
+
+storage_backend = create_storage_backend(STORAGE_BACKEND)
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら新たに実行せず、その完了を待って結果（または例外）を共有する。
+    スレッドから呼ぶ前提（非同期ハンドラからはrun_in_threadpool経由で使う）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, Dict[str, Any]] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: Any, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"executed": self.executed, "shared": self.shared, "inFlight": len(self._calls)}
+
+# blobダウンロードと分析（Gemini呼び出し）の重複実行を防ぐ
+download_flight = SingleFlight()
+analysis_flight = SingleFlight()
+
+class VideoBlobCache:
+    """
+    GCS動画blobのローカルLRUディスクキャッシュ。
+    キーはblob名+generationのハッシュなので、上書きされたblobは別エントリになる。
+    使用中（acquire済み）のエントリは追い出さない。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.downloaded_bytes = 0
+        # 前回プロセスの残骸はインデックスに載っていないので削除する
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def cache_key(blob_name: str, generation: Any) -> str:
+        return hashlib.sha256(f"{blob_name}#{generation}".encode("utf-8")).hexdigest()
+
+    def _path_for(self, key: str, blob_name: str) -> Path:
+        return self.cache_dir / f"{key}{Path(blob_name).suffix}"
+
+    def acquire(self, blob) -> str:
+        """blob（get_blob済みでgenerationを持つもの）のローカルパスを返す。release()で解放すること"""
+        key = self.cache_key(blob.name, blob.generation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["pins"] += 1
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return str(entry["path"])
+            self.misses += 1
+
+        # 同じblobへの同時ミスは1回のダウンロードにまとめる
+        path = self._path_for(key, blob.name)
+        download_flight.do(key, self._download, blob, path)
+        size = path.stat().st_size
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"path": path, "size": size, "pins": 0}
+                self._entries[key] = entry
+                self.downloaded_bytes += size
+            entry["pins"] += 1
+            self._entries.move_to_end(key)
+            self._evict_locked()
+        return str(path)
+
+    def lookup(self, blob) -> Optional[str]:
+        """キャッシュ済みならダウンロードせずにローカルパスを返す（release()で解放すること）"""
+        key = self.cache_key(blob.name, blob.generation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry["pins"] += 1
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return str(entry["path"])
+
+    def _download(self, blob, path: Path) -> None:
+        part_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+        try:
+            if not storage_backend.download_to_file(blob.name, str(part_path), generation=blob.generation):
+                raise FileNotFoundError(f"Blob {blob.name} not found in GCS")
+            os.replace(part_path, path)
+        finally:
+            if part_path.exists():
+                part_path.unlink()
+
+    def release(self, local_path: str) -> None:
+        with self._lock:
+            for entry in self._entries.values():
+                if str(entry["path"]) == local_path:
+                    entry["pins"] = max(0, entry["pins"] - 1)
+                    break
+            self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        total = sum(entry["size"] for entry in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry["pins"] > 0:
+                continue
+            del self._entries[key]
+            total -= entry["size"]
+            self.evictions += 1
+            try:
+                entry["path"].unlink()
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(entry["size"] for entry in self._entries.values()),
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / requests, 3) if requests else 0.0,
+                "evictions": self.evictions,
+                "downloadedBytes": self.downloaded_bytes
+            }
+
+video_cache = VideoBlobCache(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES)
+
 @lru_cache(maxsize=1)
 def get_chroma_client():
     """ChromaDBクライアントを取得（外部サーバー対応）"""
@@ -299,52 +1159,183 @@ def retrieve_from_chroma_langchain(query: str, k: int = DEFAULT_RETRIEVAL_K) ->
         print(f"Langchain Chroma retrieval error: {e}")
         return []
 
-def analyze_and_generate_advice(
-    frames: list, 
-    problem_type: str, 
-    crux: str, 
-    output_language: str
-) -> Tuple[str, str, List[Source]]:
-    """1回のGemini呼び出しで動画分析とアドバイス生成を行う"""
-    if not frames:
-        return "No frames available for analysis", "アドバイスを生成できません", []
+gemini_latency_stats = LatencyStats()
+
+# モデル名 -> GenerativeModel（プロセス全体で共有。APIキーの設定は最初の1回だけ）
+_gemini_models: Dict[str, genai.GenerativeModel] = {}
+_gemini_models_lock = threading.Lock()
+
+def get_gemini_model(model_name: str = GEMINI_MODEL_NAME) -> genai.GenerativeModel:
+    """共有のGenerativeModelを返す。取得にかかった時間は model_setup として記録する"""
+    with gemini_latency_stats.track("model_setup"):
+        with _gemini_models_lock:
+            model = _gemini_models.get(model_name)
+            if model is None:
+                if not _gemini_models:
+                    genai.configure(api_key=GEMINI_API_KEY)
+                model = genai.GenerativeModel(model_name)
+                _gemini_models[model_name] = model
+                logger.info(f"Gemini model initialized: {model_name}")
+            return model
+
+def warm_up_gemini() -> None:
+    """モデルを作り、トークン数の計算を1回呼んでAPIクライアントの接続まで済ませておく"""
+    model = get_gemini_model()
+    if GEMINI_WARMUP:
+        with gemini_latency_stats.track("warmup"):
+            model.count_tokens("warmup")
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Geminiの画像トークン数の目安（384px以下は1枚258トークン、それより大きい画像は768pxのタイルごとに258トークン）"""
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+def fit_long_edge(shape: Tuple[int, ...], long_edge: int) -> Tuple[int, int]:
+    """長辺をlong_edge以下に収めた (幅, 高さ)。拡大はしない"""
+    height, width = shape[:2]
+    scale = min(1.0, long_edge / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def encode_gemini_image(frame: np.ndarray, long_edge: int, quality: int) -> bytes:
+    """BGRフレームを縮小してJPEGにする（cv2はエンコード中にGILを解放するのでスレッドで並列化できる）"""
+    size = fit_long_edge(frame.shape, long_edge)
+    if size != (frame.shape[1], frame.shape[0]):
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise Exception("JPEG encoding failed")
+    return encoded.tobytes()
+
+_image_encode_executor = ThreadPoolExecutor(max_workers=GEMINI_IMAGE_ENCODE_WORKERS, thread_name_prefix="gemini-image")
+gemini_payload_stats = {"requests": 0, "images": 0, "bytes": 0, "estimatedTokens": 0, "reencodes": 0}
+_gemini_payload_stats_lock = threading.Lock()
+
+def build_contact_sheet(
+    frames: list,
+    labels: Optional[List[str]] = None,
+    cell_width: int = GEMINI_CONTACT_SHEET_CELL_WIDTH
+) -> np.ndarray:
+    """
+    フレームを撮影順に左上から右へ並べた1枚のグリッド画像（BGR）にする。各マスの左上にlabels（時刻など）を入れる。
+    labelsを省略すると順番の番号を入れる。余ったマスは黒のまま。
+    縮小したマスを (行, 列, 高さ, 幅, 3) の配列に入れ、軸を入れ替えて1枚にする。
+    """
+    if labels is None:
+        labels = [str(i + 1) for i in range(len(frames))]
+    columns = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / columns)
+    height, width = frames[0].shape[:2]
+    cell_height = max(1, round(height * cell_width / width))
+
+    cells = np.zeros((rows * columns, cell_height, cell_width, 3), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        cells[i] = cv2.resize(frame, (cell_width, cell_height), interpolation=cv2.INTER_AREA)
+        # どの背景でも読めるよう、黒の縁取りの上に白で描く
+        for color, thickness in (((0, 0, 0), 4), ((255, 255, 255), 2)):
+            cv2.putText(cells[i], labels[i], (8, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, thickness, cv2.LINE_AA)
+
+    return (
+        cells.reshape(rows, columns, cell_height, cell_width, 3)
+        .swapaxes(1, 2)
+        .reshape(rows * cell_height, columns * cell_width, 3)
+    )
+
+def select_gemini_images(
+    frames: list,
+    image_mode: Optional[str] = None,
+    frame_times: Optional[List[float]] = None
+) -> List[Dict[str, Any]]:
+    """
+    分析に使うフレームを選び、Geminiに渡すJPEGのパーツにする。
+    image_mode="grid" では選んだフレームを1枚のコンタクトシートにまとめ、各マスにframe_times（秒）を書き込む
+    （既定はGEMINI_IMAGE_MODE）。
+    1リクエストあたりのトークン予算に収まるまで解像度を下げ、バイト予算に収まるまで画質→解像度の順に下げる。
+    """
+    # Select frames for analysis
+    selected = select_sample_indices(len(frames))
+    selected_frames = [frames[i] for i in selected]
+    if not selected_frames:
+        return []
+
+    if (image_mode or GEMINI_IMAGE_MODE) == "grid":
+        labels = [f"{frame_times[i]:.1f}s" for i in selected] if frame_times else None
+        images = [build_contact_sheet(selected_frames, labels)]
+        long_edge = max(images[0].shape[:2])
+    else:
+        images = selected_frames
+        long_edge = GEMINI_IMAGE_MAX_EDGE
+    if GEMINI_IMAGE_TOKEN_BUDGET:
+        while long_edge > GEMINI_IMAGE_MIN_EDGE and sum(
+            estimate_image_tokens(*fit_long_edge(image.shape, long_edge)) for image in images
+        ) > GEMINI_IMAGE_TOKEN_BUDGET:
+            # 768px/384pxの境目でトークン数が変わるので、その境目まで下げる
+            long_edge = max(GEMINI_IMAGE_MIN_EDGE, 768 if long_edge > 768 else 384 if long_edge > 384 else long_edge // 2)
+
+    quality = GEMINI_IMAGE_JPEG_QUALITY
+    with gemini_latency_stats.track("image_encode"):
+        for attempt in range(4):
+            encoded = list(_image_encode_executor.map(
+                lambda image: encode_gemini_image(image, long_edge, quality), images
+            ))
+            total_bytes = sum(map(len, encoded))
+            if total_bytes <= GEMINI_IMAGE_BYTE_BUDGET or (
+                quality <= GEMINI_IMAGE_MIN_QUALITY and long_edge <= GEMINI_IMAGE_MIN_EDGE
+            ):
+                break
+            # JPEGのサイズは画質にほぼ比例して変わるので、まず画質を超過分だけ下げ、下限なら解像度を下げる
+            with _gemini_payload_stats_lock:
+                gemini_payload_stats["reencodes"] += 1
+            if quality > GEMINI_IMAGE_MIN_QUALITY:
+                quality = max(GEMINI_IMAGE_MIN_QUALITY, int(quality * GEMINI_IMAGE_BYTE_BUDGET / total_bytes))
+            else:
+                long_edge = max(GEMINI_IMAGE_MIN_EDGE, int(long_edge * math.sqrt(GEMINI_IMAGE_BYTE_BUDGET / total_bytes)))
+
+    tokens = sum(estimate_image_tokens(*fit_long_edge(image.shape, long_edge)) for image in images)
+    with _gemini_payload_stats_lock:
+        gemini_payload_stats["requests"] += 1
+        gemini_payload_stats["images"] += len(encoded)
+        gemini_payload_stats["bytes"] += total_bytes
+        gemini_payload_stats["estimatedTokens"] += tokens
+    logger.info(
+        f"Gemini image payload: {len(encoded)} images, {total_bytes} bytes, ~{tokens} tokens "
+        f"(long edge {long_edge}px, quality {quality})"
+    )
+    return [{"mime_type": "image/jpeg", "data": data} for data in encoded]
+
+# コンタクトシートを送るときにプロンプトの末尾へ加える説明
+CONTACT_SHEET_PROMPT_NOTES = {
+    "English": "\n        Note: the frames are provided as a single grid image. Read the tiles in order (left to right, top to bottom); they are in chronological order and each is labelled with its timestamp in seconds (e.g. 1.5s).\n",
+    "日本語": "\n        補足: フレームは1枚のグリッド画像にまとめてあります。マスを左上から右へ、上から下へ順に読んでください（撮影順に並んでおり、各マスには動画内の時刻（秒、例: 1.5s）が書いてあります）。\n",
+}
+
+def build_advice_prompt(
+    problem_type: str,
+    crux: str,
+    output_language: str,
+    image_mode: Optional[str] = None
+) -> Tuple[str, List[dict]]:
+    """RAGで関連知識を検索し、Geminiに渡すプロンプトを組み立てる。(プロンプト, 検索結果) を返す"""
+    # ChromaDBから関連情報を検索 (ユーザーのテキスト入力のみを使用)
+    rag_query = f"課題の種類: {problem_type}, 難しい点: {crux}"
+    print(f"[DEBUG] RAG query: {rag_query}")
+    retrieved_docs_for_gemini = retrieve_from_chroma_langchain(rag_query)
+    print(f"[DEBUG] Retrieved {len(retrieved_docs_for_gemini)} documents from ChromaDB")
+    
+    # Format retrieved_knowledge for prompt as per FR-001 and FR-002
+    formatted_knowledge_parts = []
+    if retrieved_docs_for_gemini:
+        for i, doc in enumerate(retrieved_docs_for_gemini):
+            # Using the name from metadata if available, otherwise a generic one
+            source_name = doc.get("name", f"知識{i+1}") 
+            formatted_knowledge_parts.append(f"[知識{i+1}: {source_name}]\n{doc['content']}")
+        retrieved_knowledge_for_prompt = "\n\n".join(formatted_knowledge_parts)
+    else:
+        retrieved_knowledge_for_prompt = "関連する知識は見つかりませんでした。"
         
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Select frames for analysis
-        num_frames = min(len(frames), MAX_FRAMES_FOR_GEMINI)
-        indices = np.linspace(0, len(frames) - 1, num_frames, dtype=int)
-        selected_frames = [frames[i] for i in indices]
-        
-        # Convert frames to PIL images
-        pil_images = []
-        for frame in selected_frames:
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(rgb_frame)
-            pil_images.append(pil_image)
-            
-        # ChromaDBから関連情報を検索 (ユーザーのテキスト入力のみを使用)
-        rag_query = f"課題の種類: {problem_type}, 難しい点: {crux}"
-        print(f"[DEBUG] RAG query: {rag_query}")
-        retrieved_docs_for_gemini = retrieve_from_chroma_langchain(rag_query)
-        print(f"[DEBUG] Retrieved {len(retrieved_docs_for_gemini)} documents from ChromaDB")
-        
-        # Format retrieved_knowledge for prompt as per FR-001 and FR-002
-        formatted_knowledge_parts = []
-        if retrieved_docs_for_gemini:
-            for i, doc in enumerate(retrieved_docs_for_gemini):
-                # Using the name from metadata if available, otherwise a generic one
-                source_name = doc.get("name", f"知識{i+1}") 
-                formatted_knowledge_parts.append(f"[知識{i+1}: {source_name}]\n{doc['content']}")
-            retrieved_knowledge_for_prompt = "\n\n".join(formatted_knowledge_parts)
-        else:
-            retrieved_knowledge_for_prompt = "関連する知識は見つかりませんでした。"
-            
-        # output_language の値に基づいてプロンプトを構築
-        if output_language == "English":
-            prompt = f"""**
+    # output_language の値に基づいてプロンプトを構築
+    if output_language == "English":
+        prompt = f"""**
         ### Generation Rules (Must Follow) ###
         Your response MUST be written in **English**. Do not use any other languages.
         Aim for an overall response length of about 6 to 10 sentences.
@@ -386,8 +1377,8 @@ def analyze_and_generate_advice(
         2. Try reaching for the next hold with your right hand. Twisting your body slightly will help you extend your reach.
         3. Throughout your movement, try to keep your body weight close to the wall. This will allow you to transfer weight to your feet more efficiently and move more smoothly. Take your time and proceed carefully through each move.
         """
-        elif output_language == "日本語":
-            prompt = f"""**
+    elif output_language == "日本語":
+        prompt = f"""**
        ### 生成時ルール（must rule）###
         あなたの応答は必ず**日本語**で記述してください。他の言語は一切使用しないでください。
 
@@ -429,8 +1420,8 @@ def analyze_and_generate_advice(
         2. 右手はもう一段上のホールドを目指してみてください。体を少しひねることで、手が伸ばしやすくなります。
         3. 動作全体を通して体重を壁に近づける意識を持つことで、足にしっかりと体重が乗り、次の動きがスムーズになります。焦らず丁寧にムーブを進めていきましょう。
         """
-        else: # デフォルトは英語プロンプト (念のため)
-            prompt = f"""**
+    else: # デフォルトは英語プロンプト (念のため)
+        prompt = f"""**
         ### Generation Rules (Must Follow) ###
         Your response MUST be written in **English**. Do not use any other languages.
         Aim for an overall response length of about 6 to 10 sentences.
@@ -472,9 +1463,80 @@ def analyze_and_generate_advice(
         2. Try reaching for the next hold with your right hand. Twisting your body slightly will help you extend your reach.
         3. Throughout your movement, try to keep your body weight close to the wall. This will allow you to transfer weight to your feet more efficiently and move more smoothly. Take your time and proceed carefully through each move.
         """
+    
+    if (image_mode or GEMINI_IMAGE_MODE) == "grid":
+        prompt += CONTACT_SHEET_PROMPT_NOTES["日本語" if output_language == "日本語" else "English"]
+    
+    return prompt, retrieved_docs_for_gemini
+
+def split_advice_response(full_response: str, output_language: str) -> Tuple[str, str]:
+    """Geminiの応答を「画像分析」と「アドバイス」のセクションに分ける"""
+    analysis_part = ""
+    advice_part = ""
+    
+    # 日本語の場合
+    if output_language == "日本語":
+        if "# 画像分析" in full_response and "# アドバイス" in full_response:
+            parts = full_response.split("# アドバイス")
+            analysis_part = parts[0].replace("# 画像分析", "").strip()
+            advice_part = parts[1].strip()
+        elif "画像分析" in full_response and "アドバイス" in full_response:
+            # ヘッダーが少し違う場合にも対応
+            parts = full_response.split("アドバイス")
+            analysis_part = parts[0].replace("画像分析", "").strip()
+            advice_part = parts[1].strip()
+        else:
+            # セクションが明確に分かれていない場合、最初の改行で分割を試す
+            if "\n\n" in full_response:
+                analysis_part, advice_part = full_response.split("\n\n", 1)
+            else:
+                analysis_part = "分析結果を抽出できませんでした"
+                advice_part = full_response
+    # 英語の場合
+    else:
+        if "# Image Analysis" in full_response and "# Advice" in full_response:
+            parts = full_response.split("# Advice")
+            analysis_part = parts[0].replace("# Image Analysis", "").strip()
+            advice_part = parts[1].strip()
+        elif "Image Analysis" in full_response and "Advice" in full_response:
+            # ヘッダーが少し違う場合にも対応
+            parts = full_response.split("Advice")
+            analysis_part = parts[0].replace("Image Analysis", "").strip()
+            advice_part = parts[1].strip()
+        else:
+            # セクションが明確に分かれていない場合、最初の改行で分割を試す
+            if "\n\n" in full_response:
+                analysis_part, advice_part = full_response.split("\n\n", 1)
+            else:
+                analysis_part = "Analysis could not be extracted"
+                advice_part = full_response
+    
+    return analysis_part, advice_part
+
+def analyze_and_generate_advice(
+    frames: list, 
+    problem_type: str, 
+    crux: str, 
+    output_language: str,
+    cache_key: Optional[str] = None,
+    image_mode: Optional[str] = None,
+    frame_times: Optional[List[float]] = None
+) -> Tuple[str, str, List[Source]]:
+    """
+    1回のGemini呼び出しで動画分析とアドバイス生成を行う（cache_keyを渡すと成功時の結果をキャッシュする）
+    image_mode="grid" ではフレームを1枚のコンタクトシートにまとめ、frame_times（秒）をラベルにして送る（既定はGEMINI_IMAGE_MODE）
+    """
+    if not frames:
+        return "No frames available for analysis", "アドバイスを生成できません", []
+        
+    try:
+        model = get_gemini_model()
+        image_parts = select_gemini_images(frames, image_mode, frame_times)
+        prompt, retrieved_docs_for_gemini = build_advice_prompt(problem_type, crux, output_language, image_mode)
         
         print(f"[DEBUG] Prompt to Gemini: {prompt[:200]}...") 
-        response = model.generate_content([prompt, *pil_images])
+        with gemini_latency_stats.track("generate_content"):
+            response = model.generate_content([prompt, *image_parts])
         full_response = response.text
         print(f"[DEBUG] Full response from Gemini: {full_response}")
         print(f"[DEBUG] Output language: {output_language}")
@@ -485,47 +1547,12 @@ def analyze_and_generate_advice(
         
         # レスポンスを分析とアドバイスに分割
         try:
-            analysis_part = ""
-            advice_part = ""
+            analysis_part, advice_part = split_advice_response(full_response, output_language)
             
-            # 日本語の場合
-            if output_language == "日本語":
-                if "# 画像分析" in full_response and "# アドバイス" in full_response:
-                    parts = full_response.split("# アドバイス")
-                    analysis_part = parts[0].replace("# 画像分析", "").strip()
-                    advice_part = parts[1].strip()
-                elif "画像分析" in full_response and "アドバイス" in full_response:
-                    # ヘッダーが少し違う場合にも対応
-                    parts = full_response.split("アドバイス")
-                    analysis_part = parts[0].replace("画像分析", "").strip()
-                    advice_part = parts[1].strip()
-                else:
-                    # セクションが明確に分かれていない場合、最初の改行で分割を試す
-                    if "\n\n" in full_response:
-                        analysis_part, advice_part = full_response.split("\n\n", 1)
-                    else:
-                        analysis_part = "分析結果を抽出できませんでした"
-                        advice_part = full_response
-            # 英語の場合
-            else:
-                if "# Image Analysis" in full_response and "# Advice" in full_response:
-                    parts = full_response.split("# Advice")
-                    analysis_part = parts[0].replace("# Image Analysis", "").strip()
-                    advice_part = parts[1].strip()
-                elif "Image Analysis" in full_response and "Advice" in full_response:
-                    # ヘッダーが少し違う場合にも対応
-                    parts = full_response.split("Advice")
-                    analysis_part = parts[0].replace("Image Analysis", "").strip()
-                    advice_part = parts[1].strip()
-                else:
-                    # セクションが明確に分かれていない場合、最初の改行で分割を試す
-                    if "\n\n" in full_response:
-                        analysis_part, advice_part = full_response.split("\n\n", 1)
-                    else:
-                        analysis_part = "Analysis could not be extracted"
-                        advice_part = full_response
-            
-            return analysis_part, advice_part, [Source(name=doc["name"], content=doc["content"]) for doc in retrieved_docs_for_gemini]
+            sources = [Source(name=doc["name"], content=doc["content"]) for doc in retrieved_docs_for_gemini]
+            if cache_key:
+                analysis_result_cache.put(cache_key, analysis_part, advice_part, sources)
+            return analysis_part, advice_part, sources
         except Exception as e:
             print(f"Response parsing error: {e}")
             # エラー時は分析結果、アドバイス、空のソースリストを返す
@@ -540,129 +1567,518 @@ def analyze_and_generate_advice(
         print(f"Gemini analysis and advice generation error: {e}")
         return "画像分析中にエラーが発生しました", "アドバイス生成中にエラーが発生しました", []
 
-@app.post("/upload")
-async def upload_video(video: UploadFile):
-    if not video.filename:
-        raise HTTPException(status_code=400, detail="No video file provided")
-    if not GCS_BUCKET_NAME:
-        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+class AnalysisResultCache:
+    """
+    Gemini分析結果のキャッシュ。キーは入力内容（選んだフレームのバイト列・課題情報・言語・モデル・プロンプト版）のハッシュ。
+    メモリ上のLRUに加え、disk_dirを指定するとJSONファイルにも保存する（インスタンスの再起動後も使える）。
+    """
 
-    # Generate unique filename for GCS
-    video_id = str(uuid.uuid4())
-    file_extension = os.path.splitext(video.filename)[1]
-    gcs_blob_name = f"videos/{video_id}{file_extension}"
+    def __init__(self, max_entries: int, ttl_sec: float, disk_dir: Optional[Path] = None):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
 
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(gcs_blob_name)
+    @staticmethod
+    def key(frames: list, problem_type: str, crux: str, output_language: str) -> str:
+        digest = hashlib.sha256()
+        for part in (ANALYSIS_PROMPT_VERSION, GEMINI_MODEL_NAME, GEMINI_IMAGE_MODE, problem_type, crux, output_language):
+            digest.update(part.encode("utf-8") + b"\0")
+        for i in select_sample_indices(len(frames)):
+            frame = np.ascontiguousarray(frames[i])
+            digest.update(str(frame.shape).encode("ascii"))
+            digest.update(frame.data)
+        return digest.hexdigest()
 
-        # Save uploaded file to GCS
-        content = await video.read()
-        blob.upload_from_string(content, content_type=video.content_type)
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["createdAt"] > self.ttl_sec
 
-        # Verify it's a valid video and check duration
-        temp_local_path = f"/tmp/{video_id}{file_extension}"
-        blob.download_to_filename(temp_local_path)
+    def get(self, key: str) -> Optional[Tuple[str, str, List[Source]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
 
-        with VideoFileClip(temp_local_path) as clip:
-            if clip.duration > 5.0:
-                os.remove(temp_local_path)
-                blob.delete()
-                raise HTTPException(status_code=400, detail="Video must be 5 seconds or shorter")
-        
-        os.remove(temp_local_path)
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+                with self._lock:
+                    self.disk_hits += 1
 
-        # Generate absolute preview URL
-        base_url = "https://climbing-web-app-bolt-aqbqg2qzda-an.a.run.app"
-        preview_url = f"{base_url}/video/{video_id}{file_extension}"
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return entry["geminiAnalysis"], entry["advice"], [Source(**source) for source in entry["sources"]]
 
-        return {
-            "gcsBlobName": gcs_blob_name, 
-            "videoId": video_id,
-            "previewUrl": preview_url
+    def put(self, key: str, gemini_analysis: str, advice: str, sources: List[Source]) -> None:
+        entry = {
+            "createdAt": time.time(),
+            "geminiAnalysis": gemini_analysis,
+            "advice": advice,
+            "sources": jsonable_encoder(sources)
         }
-
-    except Exception as e:
-        if 'blob' in locals() and blob.exists():
+        self._remember(key, entry)
+        if self.disk_dir:
             try:
-                blob.delete()
-            except Exception as delete_e:
-                print(f"Error deleting blob during cleanup: {delete_e}")
+                tmp_path = self.disk_dir / f"{key}.{uuid.uuid4().hex}.tmp"
+                tmp_path.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+                os.replace(tmp_path, self.disk_dir / f"{key}.json")
+            except OSError as e:
+                logger.warning(f"Failed to write analysis cache entry {key}: {e}")
 
-        if 'temp_local_path' in locals() and os.path.exists(temp_local_path):
-            os.remove(temp_local_path)
-            
-        print(f"Upload error: {e}") 
-        raise HTTPException(status_code=500, detail=f"Failed to upload video: {str(e)}")
+    def _remember(self, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
-@app.post("/upload-full-video", response_model=FullVideoUploadResponse)
-async def upload_full_video(file: UploadFile = File(...)):
-    logger.info("=== UPLOAD FULL VIDEO START ===")
-    logger.info(f"Received file: {file.filename}, content_type: {file.content_type}")
-    
-    # Validate file
-    if not file.content_type or not file.content_type.startswith('video/'):
-        logger.error(f"Invalid content type: {file.content_type}")
-        raise HTTPException(status_code=400, detail="Only video files are supported")
-    
-    if not GCS_BUCKET_NAME:
-        logger.error("GCS_BUCKET_NAME not configured")
-        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
-    
-    logger.info(f"GCS_BUCKET_NAME: {GCS_BUCKET_NAME}")
-    
-    # Check file size (100MB limit)
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self.disk_dir / f"{key}.json"
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry):
+            path.unlink(missing_ok=True)
+            return None
+        return entry
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "diskEnabled": self.disk_dir is not None
+            }
+
+analysis_result_cache = AnalysisResultCache(
+    ANALYSIS_CACHE_MAX_ENTRIES,
+    ANALYSIS_CACHE_TTL_SEC,
+    Path(ANALYSIS_CACHE_DIR) if ANALYSIS_CACHE_DIR else None
+)
+
+def analyze_and_generate_advice_cached(
+    frames: list,
+    problem_type: str,
+    crux: str,
+    output_language: str,
+    frame_times: Optional[List[float]] = None
+) -> Tuple[str, str, List[Source], bool]:
+    """analyze_and_generate_advice の結果キャッシュ付き版。最後の要素はキャッシュから返したかどうか"""
+    if not ANALYSIS_CACHE_ENABLED or not frames:
+        return (*analyze_and_generate_advice(frames, problem_type, crux, output_language, frame_times=frame_times), False)
+    cache_key = AnalysisResultCache.key(frames, problem_type, crux, output_language)
+    cached = analysis_result_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Analysis cache hit: {cache_key[:16]}")
+        return (*cached, True)
+    return (*analyze_and_generate_advice(
+        frames, problem_type, crux, output_language, cache_key=cache_key, frame_times=frame_times
+    ), False)
+
+class AdviceSectionParser:
+    """
+    ストリーミング中のGeminiの応答から「# 画像分析」「# アドバイス」の見出しを検出し、
+    テキストをセクションごとの差分に分ける。見出しがチャンクの境目で切れていても検出できるよう、
+    見出しの先頭と一致する末尾だけは次のチャンクまで保留する。
+    """
+
+    def __init__(self, output_language: str):
+        if output_language == "日本語":
+            self.headers = {"# 画像分析": "analysis", "# アドバイス": "advice"}
+        else:
+            self.headers = {"# Image Analysis": "analysis", "# Advice": "advice"}
+        self.section = "analysis"  # 見出しより前のテキストは分析として扱う
+        self.text = ""
+        self._pending = ""
+
+    def feed(self, text: str) -> List[Dict[str, str]]:
+        """チャンクを受け取り、送れるようになったイベント（section / delta）を返す"""
+        self.text += text
+        self._pending += text
+        return self._drain(final=False)
+
+    def finish(self) -> List[Dict[str, str]]:
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> List[Dict[str, str]]:
+        events = []
+        while True:
+            found = [(self._pending.find(header), header) for header in self.headers if header in self._pending]
+            if not found:
+                break
+            position, header = min(found)
+            if position:
+                events.append({"type": "delta", "section": self.section, "text": self._pending[:position]})
+            self.section = self.headers[header]
+            events.append({"type": "section", "section": self.section})
+            self._pending = self._pending[position + len(header):]
+
+        hold = 0 if final else self._partial_header_length()
+        if len(self._pending) > hold:
+            cut = len(self._pending) - hold
+            events.append({"type": "delta", "section": self.section, "text": self._pending[:cut]})
+            self._pending = self._pending[cut:]
+        return events
+
+    def _partial_header_length(self) -> int:
+        """保留中のテキストの末尾が見出しの途中までと一致する長さ"""
+        for length in range(min(len(self._pending), max(map(len, self.headers)) - 1), 0, -1):
+            suffix = self._pending[-length:]
+            if any(header.startswith(suffix) for header in self.headers):
+                return length
+        return 0
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_finish_reason(chunk) -> Optional[str]:
+    """ストリームのチャンクのfinish_reason名（STOP / SAFETY / MAX_TOKENS など）。なければNone"""
+    candidates = getattr(chunk, "candidates", None) or []
+    if not candidates:
+        return None
+    finish_reason = getattr(candidates[0], "finish_reason", None)
+    if finish_reason is None:
+        return None
+    return getattr(finish_reason, "name", str(finish_reason))
+
+def stream_advice_events(
+    frames: list,
+    problem_type: str,
+    crux: str,
+    output_language: str,
+    cache_key: Optional[str] = None,
+    cached: Optional[Tuple[str, str, List[Source]]] = None,
+    frame_times: Optional[List[float]] = None
+):
+    """
+    Geminiのストリーミング応答をServer-Sent Eventsに変換する（同期ジェネレーター。StreamingResponseがスレッドで回す）。
+    section（セクションの開始）/ delta（テキスト）/ done（/analyze-range と同じ形の最終結果）/ error を送る。
+    """
+    if cached is not None:
+        gemini_analysis, final_advice, sources = cached
+        for section, text in (("analysis", gemini_analysis), ("advice", final_advice)):
+            yield sse_event("section", {"section": section})
+            yield sse_event("delta", {"section": section, "text": text})
+        yield sse_event("done", jsonable_encoder(AnalysisResponse(advice=final_advice, sources=sources, geminiAnalysis=gemini_analysis)))
+        return
+
+    if not frames:
+        yield sse_event("error", {"detail": "No frames available for analysis"})
+        return
+
+    try:
+        model = get_gemini_model()
+        image_parts = select_gemini_images(frames, frame_times=frame_times)
+        prompt, retrieved_docs_for_gemini = build_advice_prompt(problem_type, crux, output_language)
+
+        parser = AdviceSectionParser(output_language)
+        started = time.perf_counter()
+        first_token = True
+        chunk = None
+        for chunk in model.generate_content([prompt, *image_parts], stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # テキストを含まないチャンク（安全性フィルターの情報など）は飛ばす
+                continue
+            if first_token:
+                gemini_latency_stats.record("stream_first_token", time.perf_counter() - started)
+                first_token = False
+            for event in parser.feed(text):
+                yield sse_event(event.pop("type"), event)
+        for event in parser.finish():
+            yield sse_event(event.pop("type"), event)
+        gemini_latency_stats.record("generate_content_stream", time.perf_counter() - started)
+
+        # ブロックされた・途中で打ち切られた応答は結果にせず、キャッシュにも入れない
+        finish_reason = stream_finish_reason(chunk)
+        if not parser.text.strip() or finish_reason != "STOP":
+            logger.warning(f"Streaming Gemini analysis ended without a usable response (finish_reason={finish_reason})")
+            yield sse_event("error", {"detail": f"Gemini response was incomplete or blocked (finish_reason={finish_reason})"})
+            return
+
+        # 最終結果は非ストリーミング版と同じ規則でセクションに分ける
+        gemini_analysis, final_advice = split_advice_response(parser.text, output_language)
+        sources = [Source(name=doc["name"], content=doc["content"]) for doc in retrieved_docs_for_gemini]
+        if cache_key:
+            analysis_result_cache.put(cache_key, gemini_analysis, final_advice, sources)
+        yield sse_event("done", jsonable_encoder(AnalysisResponse(advice=final_advice, sources=sources, geminiAnalysis=gemini_analysis)))
+    except Exception as e:
+        logger.error(f"Streaming Gemini analysis failed: {e}")
+        yield sse_event("error", {"detail": str(e)})
+
+@app.on_event("startup")
+async def warm_up_shared_clients():
+    """コールドスタート後の最初のリクエストで初期化コストを払わないよう、共有クライアントを先に作る"""
+    try:
+        storage_backend.warm_up()
+    except Exception as e:
+        logger.warning(f"Storage backend warm-up failed: {e}")
+    # Cloud Runは起動処理が終わるまで起動プローブを通さないので、最初のリクエストは準備済みのモデルを使う
+    try:
+        await run_in_threadpool(warm_up_gemini)
+    except Exception as e:
+        logger.warning(f"Gemini warm-up failed: {e}")
+
+@app.post("/upload")
+async def upload_video(video: UploadFile):
+    if not video.filename:
+        raise HTTPException(status_code=400, detail="No video file provided")
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+
+    # Generate unique filename for GCS
+    video_id = str(uuid.uuid4())
+    file_extension = os.path.splitext(video.filename)[1]
+    gcs_blob_name = f"videos/{video_id}{file_extension}"
+
+    uploaded = False
+    try:
+        # 受信済みのスプールファイルをそのまま検証する（別のファイルには書き出さない）
+        # Verify it's a valid video and check duration before anything goes to GCS
+        spooled_path = await run_in_threadpool(spooled_upload_path, video)
+        media_info = await probe_media_info(spooled_path)
+        if media_info is None:
+            raise HTTPException(status_code=400, detail="Could not read video file")
+        if media_info.duration > 5.0:
+            raise HTTPException(status_code=400, detail="Video must be 5 seconds or shorter")
+
+        # 検証済みの同じスプールファイルから、メディア情報をメタデータとして付けてアップロードする
+        await run_in_threadpool(
+            storage_backend.upload_fileobj, gcs_blob_name, video.file, video.content_type,
+            media_info_metadata(media_info)
+        )
+        uploaded = True
+
+        # Generate absolute preview URL
+        base_url = "https://climbing-web-app-bolt-aqbqg2qzda-an.a.run.app"
+        preview_url = f"{base_url}/video/{video_id}{file_extension}"
+
+        return {
+            "gcsBlobName": gcs_blob_name, 
+            "videoId": video_id,
+            "previewUrl": preview_url
+        }
+
+    except HTTPException:
+        # 検証で弾いた動画は400のまま返す
+        if uploaded:
+            await delete_uploaded_blob(gcs_blob_name)
+        raise
+    except Exception as e:
+        if uploaded:
+            await delete_uploaded_blob(gcs_blob_name)
+            
+        print(f"Upload error: {e}") 
+        raise HTTPException(status_code=500, detail=f"Failed to upload video: {str(e)}")
+
+def spooled_upload_path(upload: UploadFile) -> str:
+    """
+    UploadFileのスプールファイルをディスクに書き出し（rollover）、ffprobeに渡せるパスを返す。
+    名前のない一時ファイル（LinuxのO_TMPFILE）は /proc/<pid>/fd/<fd> 経由で子プロセスから開く。
+    """
+    spooled = upload.file
+    if hasattr(spooled, "rollover"):
+        spooled.rollover()
+    spooled.flush()
+    name = getattr(spooled, "name", None)
+    if isinstance(name, str) and os.path.exists(name):
+        return name
+    return f"/proc/{os.getpid()}/fd/{spooled.fileno()}"
+
+async def delete_uploaded_blob(blob_name: str) -> None:
+    """エラー時の後始末。削除に失敗しても元のエラーを優先する"""
+    try:
+        await run_in_threadpool(storage_backend.delete, blob_name)
+    except Exception as delete_e:
+        print(f"Error deleting blob during cleanup: {delete_e}")
+
+def validate_full_video_upload(file: UploadFile) -> None:
+    """フル動画アップロードのリクエストを検証する"""
+    logger.info(f"Received file: {file.filename}, content_type: {file.content_type}")
+    
+    # Validate file
+    if not file.content_type or not file.content_type.startswith('video/'):
+        logger.error(f"Invalid content type: {file.content_type}")
+        raise HTTPException(status_code=400, detail="Only video files are supported")
+    
+    if not GCS_BUCKET_NAME:
+        logger.error("GCS_BUCKET_NAME not configured")
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+    
+    logger.info(f"GCS_BUCKET_NAME: {GCS_BUCKET_NAME}")
+
+async def receive_full_video_upload(file: UploadFile) -> Tuple[str, Path, str]:
+    """アップロードされた動画をディスクに書き出し、(file_id, 保存先パス, 内容のMD5) を返す"""
+    # Check file size (100MB limit)
     MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
     
     # Create unique filename
     file_id = str(uuid.uuid4())
     original_extension = Path(file.filename or "video.mp4").suffix
     original_filename = f"{file_id}_original{original_extension}"
-    optimized_filename = f"{file_id}_optimized.mp4"
-    gcs_blob_name = f"videos/{optimized_filename}"
-    
-    logger.info(f"Generated IDs - file_id: {file_id}, original: {original_filename}, optimized: {optimized_filename}")
-    
     original_path = UPLOAD_DIR / original_filename
-    optimized_path = UPLOAD_DIR / optimized_filename
     
-    logger.info(f"Paths - original: {original_path}, optimized: {optimized_path}")
+    logger.info(f"Generated IDs - file_id: {file_id}, original: {original_filename}")
     logger.info(f"UPLOAD_DIR: {UPLOAD_DIR}")
     
     try:
         # Ensure upload directory exists
-        logger.info("Creating upload directory...")
         UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Upload directory created/verified: {UPLOAD_DIR}")
         
         # Stream file to disk with size check and progress tracking
         logger.info("Starting file streaming...")
         total_size = 0
+        md5 = hashlib.md5()  # 重複アップロードの判定用に、書き出しながら計算する
         with open(original_path, "wb") as buffer:
             while chunk := await file.read(8192):  # 8KB chunks for better memory management
                 total_size += len(chunk)
+                md5.update(chunk)
                 if total_size > MAX_FILE_SIZE:
                     buffer.close()
                     os.remove(original_path)
                     logger.error(f"File size limit exceeded: {total_size} > {MAX_FILE_SIZE}")
                     raise HTTPException(status_code=413, detail=f"File size exceeds {MAX_FILE_SIZE // (1024*1024)}MB limit")
                 buffer.write(chunk)
-        
-        logger.info(f"File uploaded successfully: {total_size} bytes")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Exception while receiving upload: {type(e).__name__}: {str(e)}")
+        if original_path.exists():
+            original_path.unlink()
+        raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
+    
+    logger.info(f"File uploaded successfully: {total_size} bytes")
+    return file_id, original_path, md5.hexdigest()
+
+# Upload fingerprint dedupe
+FINGERPRINT_PREFIX = "fingerprints"
+dedupe_stats = {"hits": 0, "misses": 0, "expired": 0, "recorded": 0}
+_dedupe_stats_lock = threading.Lock()
+
+def count_dedupe(key: str) -> None:
+    with _dedupe_stats_lock:
+        dedupe_stats[key] += 1
+
+def md5_hex_from_blob(blob) -> Optional[str]:
+    """ストレージが計算済みのMD5（base64）を16進にする。複合オブジェクトなどMD5がなければNone"""
+    if not getattr(blob, "md5_hash", None):
+        return None
+    return base64.b64decode(blob.md5_hash).hex()
+
+def file_md5_hex(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def fingerprint_blob_name(fingerprint: str) -> str:
+    """指紋の記録のblob名。出力設定が変わったら別の記録になるよう、設定も名前に含める"""
+    return f"{FINGERPRINT_PREFIX}/{fingerprint}_{OPTIMIZED_WIDTH}x{OPTIMIZED_HEIGHT}@{OPTIMIZED_FPS}.json"
+
+def find_duplicate_upload(fingerprint: Optional[str], original_file_name: str) -> Optional[FullVideoUploadResponse]:
+    """
+    同じ内容の動画を最適化済みなら、そのときのレスポンスを返す（ブロッキング）。
+    記録が期限切れか、最適化済み動画がライフサイクルルールで削除済みならNone。
+    """
+    if not DEDUPE_ENABLED or not fingerprint:
+        return None
+    record_blob = storage_backend.get_blob(fingerprint_blob_name(fingerprint))
+    if record_blob is None:
+        count_dedupe("misses")
+        return None
+    try:
+        record = json.loads(storage_backend.read_range(
+            record_blob.name, 0, record_blob.size - 1, generation=record_blob.generation
+        ))
+        response = FullVideoUploadResponse(**record["response"])
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable fingerprint record {record_blob.name}: {e}")
+        count_dedupe("misses")
+        return None
+    if time.time() - record["createdAt"] > DEDUPE_TTL_SEC or not storage_backend.exists(response.gcsBlobName):
+        count_dedupe("expired")
+        return None
+    count_dedupe("hits")
+    response.metadata.originalFileName = original_file_name
+    return response
+
+def record_upload_fingerprint(fingerprint: Optional[str], response: FullVideoUploadResponse) -> None:
+    """最適化の結果を指紋と結び付けて保存する（ブロッキング）。失敗しても処理は止めない"""
+    if not DEDUPE_ENABLED or not fingerprint:
+        return
+    try:
+        record = {"createdAt": time.time(), "response": jsonable_encoder(response)}
+        storage_backend.upload_bytes(
+            fingerprint_blob_name(fingerprint), json.dumps(record).encode("utf-8"), "application/json"
+        )
+        count_dedupe("recorded")
+    except Exception as e:
+        logger.warning(f"Upload fingerprint {fingerprint} was not recorded: {e}")
+
+ProgressCallback = Callable[..., None]
+
+def _ignore_progress(stage: str, progress: float, detail: Optional[Dict[str, Any]] = None) -> None:
+    pass
+
+def transcode_progress_reporter(report: ProgressCallback, start: float = 0.1, end: float = 0.8) -> Callable[[Dict[str, Any]], None]:
+    """ffmpegの進捗（0〜1）を全体進捗の start〜end に割り当てて report に渡す"""
+    def on_progress(info: Dict[str, Any]) -> None:
+        report("transcode", start + (end - start) * info["fraction"], info)
+    return on_progress
+
+async def run_full_video_pipeline(
+    original_path: Path,
+    file_id: str,
+    original_file_name: str,
+    request: Optional[Request] = None,
+    report: ProgressCallback = _ignore_progress,
+    fingerprint: Optional[str] = None,
+) -> FullVideoUploadResponse:
+    """ディスク上の動画を ffprobe → FFmpeg最適化 → ストレージ保存 まで処理する
+
+    report(stage, progress, detail) には処理段階と全体の進捗（0.0〜1.0）、
+    段階ごとの詳細（エンコード速度など）が通知される。
+    fingerprint（内容のMD5）が前回のアップロードと一致すれば、最適化せずに前回の結果を返す。
+    """
+    optimized_filename = f"{file_id}_optimized.mp4"
+    gcs_blob_name = f"videos/{optimized_filename}"
+    optimized_path = UPLOAD_DIR / optimized_filename
+    
+    logger.info(f"Paths - original: {original_path}, optimized: {optimized_path}")
+    
+    try:
         logger.info(f"File exists: {original_path.exists()}")
-        logger.info(f"Starting video processing for file: {original_filename}")
+        logger.info(f"Starting video processing for file: {original_path.name}")
         
-        # Get video metadata before optimization
-        logger.info("Running ffprobe to get duration...")
-        duration_cmd = [
-            'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', str(original_path)
-        ]
-        duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-        logger.info(f"ffprobe result: returncode={duration_result.returncode}, stdout='{duration_result.stdout}', stderr='{duration_result.stderr}'")
+        duplicate = await run_in_threadpool(find_duplicate_upload, fingerprint, original_file_name)
+        if duplicate is not None:
+            logger.info(f"Duplicate upload (md5={fingerprint}), reusing {duplicate.gcsBlobName}")
+            os.remove(original_path)
+            return duplicate
         
-        original_duration = float(duration_result.stdout.strip()) if duration_result.returncode == 0 else 0
+        # Get video metadata before optimization
+        report("probe", 0.05)
+        logger.info("Running ffprobe to get media info...")
+        media_info = await probe_media_info(str(original_path))
+        original_duration = media_info.duration if media_info else 0
         logger.info(f"Detected duration: {original_duration} seconds")
         
         # Check duration limit (30 seconds)
@@ -674,7 +2090,9 @@ async def upload_full_video(file: UploadFile = File(...)):
         # Check if ffmpeg is available
         logger.info("Checking FFmpeg availability...")
         try:
-            ffmpeg_check = subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+            ffmpeg_check = await run_process(['ffmpeg', '-version'], timeout=10, limit=False)
+            if ffmpeg_check.returncode != 0:
+                raise subprocess.CalledProcessError(ffmpeg_check.returncode, 'ffmpeg')
             logger.info(f"FFmpeg available: {ffmpeg_check.stdout[:100]}...")
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             logger.error(f"FFmpeg not available: {str(e)}")
@@ -683,26 +2101,26 @@ async def upload_full_video(file: UploadFile = File(...)):
         
         logger.info(f"Starting video optimization: {original_path} -> {optimized_path}")
         # Optimize video with enhanced settings
+        report("transcode", 0.1)
         logger.info(f"Starting FFmpeg optimization...")
-        optimization_result = optimize_video_ffmpeg(str(original_path), str(optimized_path), max_duration=30.0)
+        optimization_result = await optimize_video_ffmpeg(
+            str(original_path), str(optimized_path), max_duration=30.0, request=request,
+            media_info=media_info, on_progress=transcode_progress_reporter(report)
+        )
         logger.info(f"FFmpeg optimization completed successfully")
         logger.info(f"Video optimization completed: {optimization_result}")
         
-        # Clean up original file to save space
-        logger.info("Cleaning up original file...")
-        os.remove(original_path)
-        
         # Upload optimized video to GCS
+        report("gcs-upload", 0.8)
         logger.info("Uploading to GCS...")
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(gcs_blob_name)
-        
-        with open(optimized_path, "rb") as video_file:
-            blob.upload_from_file(video_file, content_type="video/mp4")
+        hls_manifest = await store_optimized_video(optimized_path, gcs_blob_name, optimization_result['mediaInfo'])
         
         logger.info("GCS upload completed")
         
+        # Clean up original file to save space（保存が終わるまで残しておき、ジョブの再実行に備える）
+        logger.info("Cleaning up original file...")
+        os.remove(original_path)
+        
         # Clean up local optimized file
         logger.info("Cleaning up optimized file...")
         os.remove(optimized_path)
@@ -713,12 +2131,13 @@ async def upload_full_video(file: UploadFile = File(...)):
         
         # Create metadata
         metadata = VideoMetadata(
-            originalFileName=file.filename or "video.mp4",
+            originalFileName=original_file_name,
             originalSize=optimization_result['originalSize'],
             originalDuration=original_duration,
             optimizedSize=optimization_result['optimizedSize'],
             optimizedDuration=optimization_result['optimizedDuration'],
-            compressionRatio=optimization_result['compressionRatio']
+            compressionRatio=optimization_result['compressionRatio'],
+            processingPath=optimization_result['processingPath']
         )
         
         # Create response
@@ -726,10 +2145,10 @@ async def upload_full_video(file: UploadFile = File(...)):
             gcsBlobName=gcs_blob_name,
             videoId=file_id,
             metadata=metadata,
-            previewUrl=preview_url
+            previewUrl=preview_url,
+            hlsManifestUrl=f"{base_url}/video/{file_id}/hls/{HLS_MASTER_PLAYLIST}" if hls_manifest else None
         )
-        
-        logger.info("=== UPLOAD FULL VIDEO SUCCESS ===")
+        await run_in_threadpool(record_upload_fingerprint, fingerprint, response)
         return response
         
     except HTTPException:
@@ -748,81 +2167,335 @@ async def upload_full_video(file: UploadFile = File(...)):
         error_details = traceback.format_exc()
         logger.error(f"Full video upload error: {str(e)}")
         logger.error(f"Full error traceback: {error_details}")
-        logger.error("=== UPLOAD FULL VIDEO FAILED ===")
         raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
 
-@app.post("/analyze", response_model=AnalysisResponse)
-async def analyze_video(settings: AnalysisSettings, x_language: Optional[str] = Header(None, alias="X-Language")):
-    if not settings.gcsBlobName:
-        raise HTTPException(status_code=400, detail="gcsBlobName must be provided in settings")
-    if not GCS_BUCKET_NAME:
-        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+# ffmpegがパイプから読めるMP4/MOVの先頭ボックス
+MP4_TOP_LEVEL_BOXES = (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip")
 
-    temp_local_path = f"/tmp/{os.path.basename(settings.gcsBlobName)}" 
+def mp4_requires_seeking(head: bytes) -> Optional[bool]:
+    """
+    先頭のバイト列からMP4/MOVのボックスの並びを調べる。
+    mdatがmoovより先（moovが末尾）ならTrue、moovが先ならFalse、判定できなければNone。
+    MP4/MOV以外の形式はパイプで読めるものとしてFalseを返す。
+    """
+    if head[4:8] not in MP4_TOP_LEVEL_BOXES:
+        return False
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return False
+        if box_type == b"mdat":
+            return True
+        if size == 1:
+            # 64bitのサイズ
+            if offset + 16 > len(head):
+                return None
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return None
+        offset += size
+    return None
+
+async def stream_full_video_pipeline(
+    file: UploadFile,
+    request: Optional[Request] = None,
+    report: ProgressCallback = _ignore_progress,
+    max_duration: float = 30.0
+) -> Optional[FullVideoUploadResponse]:
+    """
+    受信した動画を元ファイルとして保存せず、チャンクのままffmpegの標準入力へ流して最適化する。
+    サイズと長さの制限は流しながら確認する。シークが必要な入力（moovが末尾のMP4）では
+    何もせずNoneを返すので、呼び出し側は従来どおりファイルに保存してから処理する。
+    """
+    MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+
+    head = await file.read(STREAMING_UPLOAD_PROBE_BYTES)
+    await file.seek(0)
+    if mp4_requires_seeking(head) is not False:
+        logger.info("Input needs seeking (moov at end or unknown layout), falling back to file-based processing")
+        return None
+
+    file_id = str(uuid.uuid4())
+    optimized_filename = f"{file_id}_optimized.mp4"
+    gcs_blob_name = f"videos/{optimized_filename}"
+    optimized_path = UPLOAD_DIR / optimized_filename
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    received = 0
+    # 流しながら内容のMD5を計算し、最後まで読めたときだけ重複判定用に記録する
+    md5 = hashlib.md5()
+    fingerprint = None
+
+    async def upload_chunks():
+        nonlocal received, fingerprint
+        while chunk := await file.read(1024 * 1024):
+            received += len(chunk)
+            if received > MAX_FILE_SIZE:
+                logger.error(f"File size limit exceeded: {received} > {MAX_FILE_SIZE}")
+                raise HTTPException(status_code=413, detail=f"File size exceeds {MAX_FILE_SIZE // (1024*1024)}MB limit")
+            md5.update(chunk)
+            yield chunk
+        fingerprint = md5.hexdigest()
+
+    on_transcode_progress = transcode_progress_reporter(report)
+
+    def on_progress(info: Dict[str, Any]) -> None:
+        # 長さは事前に分からないので、エンコード済みの時間が制限を超えた時点で打ち切る
+        if info["outTimeSec"] > max_duration + 0.1:
+            logger.error(f"Duration limit exceeded while streaming: {info['outTimeSec']} > {max_duration} seconds")
+            raise HTTPException(status_code=400, detail="Video must be 30 seconds or shorter")
+        on_transcode_progress(info)
 
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(settings.gcsBlobName)
+        report("transcode", 0.1)
+        progress = FFmpegProgressParser(max_duration, on_progress)
+        cmd = build_optimize_command("pipe:0", str(optimized_path), None, "transcode")
+        logger.info(f"Streaming FFmpeg command: {' '.join(cmd)}")
+        result = await run_process(
+            cmd,
+            timeout=300,
+            on_stdout_line=progress.feed,
+            on_stderr_line=lambda line: logger.debug(f"FFmpeg: {line}"),
+            request=request,
+            stdin_chunks=upload_chunks()
+        )
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg failed (code {result.returncode}): {result.stderr}")
+        if not optimized_path.exists() or optimized_path.stat().st_size == 0:
+            raise Exception("Output file is empty")
 
-        if not blob.exists():
-            raise HTTPException(status_code=404, detail=f"Video blob {settings.gcsBlobName} not found in GCS")
+        optimized_size = optimized_path.stat().st_size
+        media_info = await probe_media_info(str(optimized_path), timeout=10)
+        duration = media_info.duration if media_info and media_info.duration else max_duration
+        encode_speed = progress.last.get("speed")
+        if encode_speed:
+            encode_speed_stats.record(OPTIMIZE_PRESET, encode_speed)
+        logger.info(f"Streamed {received} bytes through FFmpeg -> {optimized_size} bytes, speed={encode_speed}x")
+
+        report("gcs-upload", 0.8)
+        hls_manifest = await store_optimized_video(optimized_path, gcs_blob_name, media_info)
+
+        base_url = "https://climbing-web-app-bolt-aqbqg2qzda-an.a.run.app"
+        response = FullVideoUploadResponse(
+            gcsBlobName=gcs_blob_name,
+            videoId=file_id,
+            metadata=VideoMetadata(
+                originalFileName=file.filename or "video.mp4",
+                originalSize=received,
+                originalDuration=duration,  # 入力は保存しないので、出力の長さで代用する
+                optimizedSize=optimized_size,
+                optimizedDuration=duration,
+                compressionRatio=((received - optimized_size) / received) * 100 if received else 0.0,
+                processingPath="transcode"
+            ),
+            previewUrl=f"{base_url}/video/{optimized_filename}",
+            hlsManifestUrl=f"{base_url}/video/{file_id}/hls/{HLS_MASTER_PLAYLIST}" if hls_manifest else None
+        )
+        await run_in_threadpool(record_upload_fingerprint, fingerprint, response)
+        return response
+    except HTTPException:
+        raise
+    except subprocess.TimeoutExpired:
+        logger.error("Streaming FFmpeg processing timed out (300 seconds)")
+        raise HTTPException(status_code=500, detail="Video processing timed out. Please try with a shorter video.")
+    except Exception as e:
+        logger.error(f"Streaming video processing failed: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
+    finally:
+        if optimized_path.exists():
+            optimized_path.unlink()
 
-        blob.download_to_filename(temp_local_path)
+@app.post("/upload-full-video", response_model=FullVideoUploadResponse)
+async def upload_full_video(request: Request, file: UploadFile = File(...)):
+    logger.info("=== UPLOAD FULL VIDEO START ===")
+    validate_full_video_upload(file)
+    
+    try:
+        # ストリーミングできない入力（Noneが返る）は、ディスクに保存してから処理する
+        response = await stream_full_video_pipeline(file, request=request) if STREAMING_UPLOAD else None
+        if response is None:
+            file_id, original_path, fingerprint = await receive_full_video_upload(file)
+            response = await run_full_video_pipeline(
+                original_path, file_id, file.filename or "video.mp4", request=request, fingerprint=fingerprint
+            )
+    except HTTPException:
+        logger.error("=== UPLOAD FULL VIDEO FAILED ===")
+        raise
+    
+    logger.info("=== UPLOAD FULL VIDEO SUCCESS ===")
+    return response
+
+def get_analysis_blob(blob_name: str):
+    """
+    分析に使うblobを返す。取り込み時に作った分析用プロキシがあればそれを使い、
+    なければ元のblobを返す（どちらもなければNone）。
+    """
+    if ANALYSIS_PROXY_ENABLED and os.path.splitext(blob_name)[0].endswith("_optimized"):
+        proxy_blob = storage_backend.get_blob(analysis_proxy_blob_name(blob_name))
+        if proxy_blob is not None:
+            return proxy_blob
+    return storage_backend.get_blob(blob_name)
 
-        with VideoFileClip(temp_local_path) as clip:
-            end_time = min(settings.startTime + 1.0, clip.duration)
+def run_video_analysis(settings: AnalysisSettings, output_language: str) -> Tuple[AnalysisResponse, bool]:
+    """/analyze の本体。ブロッキング処理なのでスレッドプールから呼び出す。(結果, キャッシュヒットか) を返す"""
+    temp_local_path = None
 
-        frames = extract_frames(temp_local_path, settings.startTime, end_time)
-        
-        # 言語設定の取得 (FR-001, FR-002, TR-001)
-        output_language = "English" # Default to English
-        print(f"[DEBUG] Received X-Language header: {x_language}")
-        if x_language:
-            if x_language.lower().startswith("ja"):
-                output_language = "日本語"
-            elif x_language.lower().startswith("en"):
-                output_language = "English"
-            # 上記以外の場合はデフォルトの「英語」のまま
-        print(f"[DEBUG] Determined output_language: {output_language}")
+    try:
+        blob = get_analysis_blob(settings.gcsBlobName)
+
+        if blob is None:
+            raise HTTPException(status_code=404, detail=f"Video blob {settings.gcsBlobName} not found in GCS")
+
+        # 長さは保存済みのメタデータから取り、なければファイルを取得して調べる
+        media_info = media_info_from_metadata(getattr(blob, "metadata", None))
+        if media_info is None:
+            temp_local_path = video_cache.acquire(blob)
+            media_info = get_media_info(blob, temp_local_path)
+        end_time = min(settings.startTime + 1.0, media_info.duration)
+
+        # フレームストアがあれば使うフレームのバイトだけを読み、なければ動画をデコードする
+        stored = load_stored_frames(settings.gcsBlobName, settings.startTime, end_time)
+        if stored is not None:
+            frames, frame_times = stored
+        else:
+            if temp_local_path is None:
+                temp_local_path = video_cache.acquire(blob)
+            frames, frame_times = extract_analysis_frames(temp_local_path, settings.startTime, end_time)
         
-        # 1回のGemini呼び出しで分析とアドバイス生成、RAG結果取得を行う
-        gemini_analysis, final_advice, retrieved_sources = analyze_and_generate_advice(
+        # 1回のGemini呼び出しで分析とアドバイス生成、RAG結果取得を行う（同じ入力なら前回の結果を使う）
+        gemini_analysis, final_advice, retrieved_sources, cache_hit = analyze_and_generate_advice_cached(
             frames,
             settings.problemType,
             settings.crux,
-            output_language
+            output_language,
+            frame_times
         )
-                
-        if os.path.exists(temp_local_path):
-            os.remove(temp_local_path)
             
         return AnalysisResponse(
             advice=final_advice,
             sources=retrieved_sources,
             geminiAnalysis=gemini_analysis
-        )
+        ), cache_hit
+    finally:
+        # キャッシュ上のファイルは削除せず、使用中の印だけ外す
+        if temp_local_path:
+            video_cache.release(temp_local_path)
+
+@app.post("/analyze", response_model=AnalysisResponse)
+async def analyze_video(settings: AnalysisSettings, response: Response, x_language: Optional[str] = Header(None, alias="X-Language")):
+    if not settings.gcsBlobName:
+        raise HTTPException(status_code=400, detail="gcsBlobName must be provided in settings")
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+
+    # 言語設定の取得 (FR-001, FR-002, TR-001)
+    output_language = "English" # Default to English
+    print(f"[DEBUG] Received X-Language header: {x_language}")
+    if x_language:
+        if x_language.lower().startswith("ja"):
+            output_language = "日本語"
+        elif x_language.lower().startswith("en"):
+            output_language = "English"
+        # 上記以外の場合はデフォルトの「英語」のまま
+    print(f"[DEBUG] Determined output_language: {output_language}")
+
+    try:
+        # 同じ入力の分析が実行中なら、その結果を共有する
+        flight_key = ("analyze", settings.gcsBlobName, settings.startTime, settings.problemType, settings.crux, output_language)
+        result, cache_hit = await run_in_threadpool(analysis_flight.do, flight_key, run_video_analysis, settings, output_language)
+        response.headers["X-Analysis-Cache"] = "HIT" if cache_hit else "MISS"
+        return result
         
     except Exception as e:
-        if os.path.exists(temp_local_path):
-            os.remove(temp_local_path)
         print(f"Analysis error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to analyze video: {str(e)}")
 
-@app.post("/analyze-range", response_model=AnalysisResponse)
-async def analyze_video_range(settings: RangeAnalysisSettings, x_language: Optional[str] = Header(None, alias="X-Language")):
-    """指定された時間範囲での動画分析（新機能）"""
-    
-    # 🔥 詳細なリクエストログを追加
-    logger.info(f"=== analyze_video_range called ===")
-    logger.info(f"Request settings: {settings}")
-    logger.info(f"problemType: {settings.problemType}")
-    logger.info(f"crux: {settings.crux}")
-    logger.info(f"startTime: {settings.startTime}")
-    logger.info(f"endTime: {settings.endTime}")
-    logger.info(f"gcsBlobName: {settings.gcsBlobName}")
-    logger.info(f"X-Language header: {x_language}")
-    
+def load_range_analysis_frames(
+    settings: RangeAnalysisSettings,
+    report: ProgressCallback = _ignore_progress
+) -> Tuple[list, List[float]]:
+    """範囲分析に使うフレームと各フレームの時刻（秒）を用意する（ブロッキング）。blobがなければ404、範囲が不正なら400"""
+    temp_local_path = None
+
+    try:
+        logger.info(f"GCS bucket: {GCS_BUCKET_NAME}")
+        logger.info(f"GCS blob: {settings.gcsBlobName}")
+
+        # 🔥 ファイル存在確認（メタデータ取得を兼ねる）。分析用プロキシがあればそちらを使う
+        logger.info("🔄 Fetching blob metadata...")
+        blob = get_analysis_blob(settings.gcsBlobName)
+        if blob is None:
+            logger.error(f"❌ BLOB NOT FOUND: {settings.gcsBlobName} not found in bucket {GCS_BUCKET_NAME}")
+            raise HTTPException(status_code=404, detail=f"Video blob {settings.gcsBlobName} not found in GCS")
+
+        # 🔥 動画ファイル検証（保存済みのメディア情報を優先し、なければローカルキャッシュ経由で取得して調べる）
+        report("download", 0.1)
+        logger.info("🔄 Reading media info...")
+        media_info = media_info_from_metadata(getattr(blob, "metadata", None))
+        if media_info is None:
+            logger.info(f"🔄 Reading {blob.name} through local cache (generation={blob.generation})...")
+            temp_local_path = video_cache.acquire(blob)
+            logger.info(f"✅ Blob available locally at {temp_local_path}")
+            media_info = get_media_info(blob, temp_local_path)
+        video_duration = media_info.duration
+        logger.info(f"Video duration: {video_duration} seconds")
+        
+        # 浮動小数点数の精度問題を考慮して、小さなマージン（0.1秒）を追加
+        duration_margin = 0.1
+        if settings.endTime > (video_duration + duration_margin):
+            logger.error(f"❌ TIME RANGE ERROR: endTime ({settings.endTime}) exceeds video duration ({video_duration}) + margin ({duration_margin})")
+            raise HTTPException(status_code=400, detail="End time exceeds video duration")
+        
+        # endTimeが動画の長さを超えている場合は、動画の長さに調整
+        actual_end_time = min(settings.endTime, video_duration)
+        logger.info(f"Adjusted endTime: {settings.endTime} -> {actual_end_time}")
+
+        # 🔥 フレーム抽出
+        report("frames", 0.3)
+        logger.info("🔄 Extracting frames...")
+        stored = load_stored_frames(settings.gcsBlobName, settings.startTime, actual_end_time)
+        if stored is not None:
+            frames, frame_times = stored
+        else:
+            if temp_local_path is None:
+                temp_local_path = video_cache.acquire(blob)
+            frames, frame_times = extract_analysis_frames(temp_local_path, settings.startTime, actual_end_time)
+        logger.info(f"✅ Extracted {len(frames)} frames")
+        return frames, frame_times
+    finally:
+        # 🔥 キャッシュ上のファイルは削除せず、使用中の印だけ外す
+        if temp_local_path:
+            video_cache.release(temp_local_path)
+
+def run_range_analysis(
+    settings: RangeAnalysisSettings,
+    output_language: str,
+    report: ProgressCallback = _ignore_progress
+) -> Tuple[AnalysisResponse, bool]:
+    """/analyze-range の本体。ブロッキング処理なのでスレッドプールから呼び出す。(結果, キャッシュヒットか) を返す"""
+    frames, frame_times = load_range_analysis_frames(settings, report)
+
+    # 🔥 AI分析開始
+    report("analysis", 0.5)
+    logger.info("🔄 Starting AI analysis...")
+    gemini_analysis, final_advice, retrieved_sources, cache_hit = analyze_and_generate_advice_cached(
+        frames,
+        settings.problemType,
+        settings.crux,
+        output_language,
+        frame_times
+    )
+    logger.info(f"✅ AI analysis completed (cache {'hit' if cache_hit else 'miss'})")
+
+    return AnalysisResponse(
+        advice=final_advice,
+        sources=retrieved_sources,
+        geminiAnalysis=gemini_analysis
+    ), cache_hit
+
+def validate_range_analysis_settings(settings: RangeAnalysisSettings) -> None:
+    """範囲分析リクエストを検証する。不正な場合はHTTPExceptionを送出"""
     # 🔥 バリデーションを詳細化
     if not settings.gcsBlobName:
         logger.error("❌ VALIDATION ERROR: gcsBlobName is missing")
@@ -847,91 +2520,53 @@ async def analyze_video_range(settings: RangeAnalysisSettings, x_language: Optio
         logger.error(f"❌ TIME RANGE ERROR: Range too long - duration={range_duration}, max_allowed={max_range_duration}")
         raise HTTPException(status_code=400, detail="Analysis range must be 3 seconds or shorter")
 
-    temp_local_path = f"/tmp/{os.path.basename(settings.gcsBlobName)}"
-    logger.info(f"Temp file path: {temp_local_path}")
-
-    try:
-        # 🔥 GCS接続確認
-        logger.info("🔄 Initializing GCS client...")
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(settings.gcsBlobName)
-        logger.info(f"GCS bucket: {GCS_BUCKET_NAME}")
-        logger.info(f"GCS blob: {settings.gcsBlobName}")
-
-        # 🔥 ファイル存在確認
-        logger.info("🔄 Checking blob existence...")
-        if not blob.exists():
-            logger.error(f"❌ BLOB NOT FOUND: {settings.gcsBlobName} not found in bucket {GCS_BUCKET_NAME}")
-            raise HTTPException(status_code=404, detail=f"Video blob {settings.gcsBlobName} not found in GCS")
+def resolve_output_language(x_language: Optional[str]) -> str:
+    """X-Language ヘッダーから出力言語を決める"""
+    output_language = "English"  # Default to English
+    logger.info(f"Received X-Language header: {x_language}")
+    if x_language:
+        if x_language.lower().startswith("ja"):
+            output_language = "日本語"
+        elif x_language.lower().startswith("en"):
+            output_language = "English"
+    logger.info(f"Determined output_language: {output_language}")
+    return output_language
 
-        # 🔥 ファイルダウンロード
-        logger.info("🔄 Downloading blob to temp file...")
-        blob.download_to_filename(temp_local_path)
-        logger.info(f"✅ Blob downloaded successfully to {temp_local_path}")
+def range_analysis_flight_key(settings: RangeAnalysisSettings, output_language: str) -> tuple:
+    return (
+        "analyze-range", settings.gcsBlobName, settings.startTime, settings.endTime,
+        settings.problemType, settings.crux, output_language
+    )
 
-        # 🔥 動画ファイル検証
-        logger.info("🔄 Validating video file with VideoFileClip...")
-        with VideoFileClip(temp_local_path) as clip:
-            video_duration = clip.duration
-            logger.info(f"Video duration: {video_duration} seconds")
-            
-            # 浮動小数点数の精度問題を考慮して、小さなマージン（0.1秒）を追加
-            duration_margin = 0.1
-            if settings.endTime > (video_duration + duration_margin):
-                logger.error(f"❌ TIME RANGE ERROR: endTime ({settings.endTime}) exceeds video duration ({video_duration}) + margin ({duration_margin})")
-                raise HTTPException(status_code=400, detail="End time exceeds video duration")
-            
-            # endTimeが動画の長さを超えている場合は、動画の長さに調整
-            actual_end_time = min(settings.endTime, video_duration)
-            logger.info(f"Adjusted endTime: {settings.endTime} -> {actual_end_time}")
+@app.post("/analyze-range", response_model=AnalysisResponse)
+async def analyze_video_range(settings: RangeAnalysisSettings, response: Response, x_language: Optional[str] = Header(None, alias="X-Language")):
+    """指定された時間範囲での動画分析（新機能）"""
+    
+    # 🔥 詳細なリクエストログを追加
+    logger.info(f"=== analyze_video_range called ===")
+    logger.info(f"Request settings: {settings}")
+    logger.info(f"problemType: {settings.problemType}")
+    logger.info(f"crux: {settings.crux}")
+    logger.info(f"startTime: {settings.startTime}")
+    logger.info(f"endTime: {settings.endTime}")
+    logger.info(f"gcsBlobName: {settings.gcsBlobName}")
+    logger.info(f"X-Language header: {x_language}")
+    
+    validate_range_analysis_settings(settings)
+    output_language = resolve_output_language(x_language)
 
-        # 🔥 フレーム抽出
-        logger.info("🔄 Extracting frames...")
-        frames = extract_frames(temp_local_path, settings.startTime, actual_end_time)
-        logger.info(f"✅ Extracted {len(frames)} frames")
-        
-        # 🔥 言語設定の取得
-        output_language = "English"  # Default to English
-        logger.info(f"Received X-Language header: {x_language}")
-        if x_language:
-            if x_language.lower().startswith("ja"):
-                output_language = "日本語"
-            elif x_language.lower().startswith("en"):
-                output_language = "English"
-        logger.info(f"Determined output_language: {output_language}")
-        
-        # 🔥 AI分析開始
-        logger.info("🔄 Starting AI analysis...")
-        gemini_analysis, final_advice, retrieved_sources = analyze_and_generate_advice(
-            frames,
-            settings.problemType,
-            settings.crux,
-            output_language
-        )
-        logger.info("✅ AI analysis completed")
-                
-        # 🔥 一時ファイル削除
-        if os.path.exists(temp_local_path):
-            os.remove(temp_local_path)
-            logger.info(f"✅ Temp file cleaned up: {temp_local_path}")
-            
+    try:
+        # 🔥 同じblob・範囲・入力の分析が実行中なら、その結果を共有する
+        flight_key = range_analysis_flight_key(settings, output_language)
+        result, cache_hit = await run_in_threadpool(analysis_flight.do, flight_key, run_range_analysis, settings, output_language)
+        response.headers["X-Analysis-Cache"] = "HIT" if cache_hit else "MISS"
         logger.info("✅ analyze_video_range completed successfully")
-        return AnalysisResponse(
-            advice=final_advice,
-            sources=retrieved_sources,
-            geminiAnalysis=gemini_analysis
-        )
+        return result
         
     except HTTPException:
         # HTTPExceptionはそのまま再発生
         raise
     except Exception as e:
-        # 🔥 一時ファイル削除
-        if os.path.exists(temp_local_path):
-            os.remove(temp_local_path)
-            logger.info(f"Temp file cleaned up after error: {temp_local_path}")
-        
         # 🔥 詳細なエラーログを出力
         import traceback
         error_traceback = traceback.format_exc()
@@ -951,6 +2586,32 @@ async def analyze_video_range(settings: RangeAnalysisSettings, x_language: Optio
         else:
             raise HTTPException(status_code=500, detail=f"Failed to analyze video range: {str(e)}")
 
+@app.post("/analyze-range/stream")
+async def analyze_video_range_stream(settings: RangeAnalysisSettings, x_language: Optional[str] = Header(None, alias="X-Language")):
+    """
+    /analyze-range のストリーミング版。Geminiの応答を生成されたそばから Server-Sent Events で送る。
+    画像分析セクションを、アドバイスの生成中から表示できる。
+    """
+    validate_range_analysis_settings(settings)
+    output_language = resolve_output_language(x_language)
+
+    # フレームの準備までは通常どおり行い、404/400はストリーム開始前にHTTPステータスで返す
+    frames, frame_times = await run_in_threadpool(load_range_analysis_frames, settings)
+    cache_key = cached = None
+    if ANALYSIS_CACHE_ENABLED and frames:
+        cache_key = await run_in_threadpool(AnalysisResultCache.key, frames, settings.problemType, settings.crux, output_language)
+        cached = await run_in_threadpool(analysis_result_cache.get, cache_key)
+
+    return StreamingResponse(
+        stream_advice_events(frames, settings.problemType, settings.crux, output_language, cache_key, cached, frame_times),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Analysis-Cache": "HIT" if cached is not None else "MISS"
+        }
+    )
+
 @app.get("/chroma-status")
 async def check_chroma_status():
     try:
@@ -1000,76 +2661,840 @@ async def check_http2_status(request: Request):
     except Exception as e:
         return {"status": f"❌ HTTP/2 status check failed: {str(e)}"}
 
-@app.get("/health")
-async def health_check():
-    """ヘルスチェックエンドポイント（HTTP/2対応確認含む）"""
+@app.get("/health")
+async def health_check():
+    """ヘルスチェックエンドポイント（HTTP/2対応確認含む）"""
+    try:
+        # 基本的なヘルスチェック
+        http2_enabled = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+        
+        # ChromaDBの接続確認
+        chroma_status = "unknown"
+        try:
+            vectorstore = get_langchain_chroma_vectorstore()
+            count = vectorstore._collection.count()
+            chroma_status = f"connected ({count} items)"
+        except Exception:
+            chroma_status = "disconnected"
+        
+        return {
+            "status": "healthy",
+            "timestamp": datetime.now().isoformat(),
+            "http2_enabled": http2_enabled,
+            "chroma_status": chroma_status,
+            "server": "hypercorn"
+        }
+    except Exception as e:
+        return {
+            "status": "unhealthy",
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }
+
+@app.get("/performance-status")
+async def check_performance_status():
+    """キャッシュ等のパフォーマンス指標を確認するエンドポイント"""
+    with _media_info_lock:
+        media_info_snapshot = dict(media_info_stats, entries=len(_media_info_cache))
+    with _dedupe_stats_lock:
+        dedupe_snapshot = dict(dedupe_stats)
+    with _gemini_payload_stats_lock:
+        gemini_payload_snapshot = dict(gemini_payload_stats)
+    return {
+        "videoCache": video_cache.stats(),
+        "videoSignedUrlCache": dict(video_signed_url_stats, entries=len(_video_signed_url_cache)),
+        "storageBackend": storage_backend.name,
+        "storageLatency": storage_latency_stats.snapshot(),
+        "downloadSingleFlight": download_flight.stats(),
+        "analysisSingleFlight": analysis_flight.stats(),
+        "jobs": job_manager.stats(),
+        "encodeSpeed": encode_speed_stats.snapshot(),
+        "mediaInfo": media_info_snapshot,
+        "uploadDedupe": dedupe_snapshot,
+        "gemini": dict(model=GEMINI_MODEL_NAME, imageMode=GEMINI_IMAGE_MODE, **gemini_latency_stats.snapshot()),
+        "analysisCache": analysis_result_cache.stats(),
+        "geminiPayload": gemini_payload_snapshot,
+        "timestamp": datetime.now().isoformat()
+    }
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    "bytes=start-end" 形式のRangeヘッダーを(start, end)（endを含む）に変換する。
+    ヘッダーなし・未対応の形式（複数範囲など）はNoneを返し、全体を返すものとする。
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+
+    start_text, _, end_text = spec.strip().partition("-")
+    try:
+        if start_text == "":
+            # サフィックス指定（末尾Nバイト）
+            suffix_length = int(end_text)
+            if suffix_length <= 0:
+                raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+            start, end = max(0, size - suffix_length), size - 1
+        else:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def iter_blob_range(blob, start: int, end: int, chunk_size: int = VIDEO_STREAM_CHUNK_SIZE):
+    """ストレージ上のblobの[start, end]をchunk_sizeごとの範囲読み出しでストリームする"""
+    position = start
+    while position <= end:
+        chunk_end = min(position + chunk_size - 1, end)
+        yield storage_backend.read_range(blob.name, position, chunk_end, generation=blob.generation)
+        position = chunk_end + 1
+
+def iter_video_range(blob, start: int, end: int, chunk_size: int = VIDEO_STREAM_CHUNK_SIZE):
+    """
+    blobの[start, end]をストリームする。解析で既にキャッシュ済みならローカルから、そうでなければGCSから読む。
+    キャッシュの使用中の印は本体を読み始めたときに付けるので、304やHEAD、送信前の切断では残らない。
+    """
+    local_path = video_cache.lookup(blob)
+    if local_path is None:
+        yield from iter_blob_range(blob, start, end, chunk_size)
+        return
+    try:
+        with open(local_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+    finally:
+        video_cache.release(local_path)
+
+def etag_matches(header_value: Optional[str], etag: str) -> bool:
+    """If-None-Match / If-Range のETag比較（弱い比較）"""
+    if not header_value:
+        return False
+    candidates = [value.strip() for value in header_value.split(",")]
+    return "*" in candidates or any(value.removeprefix("W/") == etag for value in candidates)
+
+# プレビュー用GET署名URLのキャッシュ: blob名 -> (URL, 有効期限)
+_video_signed_url_cache: Dict[str, Tuple[str, datetime]] = {}
+_video_signed_url_lock = threading.Lock()
+video_signed_url_stats = {"hits": 0, "misses": 0}
+
+def get_video_signed_url(blob_name: str) -> Tuple[str, datetime]:
+    """プレビュー用のV4署名GET URLを返す。期限切れ直前まではキャッシュを再利用する"""
+    now = datetime.utcnow()
+    with _video_signed_url_lock:
+        cached = _video_signed_url_cache.get(blob_name)
+        if cached and cached[1] - now > timedelta(seconds=VIDEO_SIGNED_URL_REFRESH_MARGIN_SEC):
+            video_signed_url_stats["hits"] += 1
+            return cached
+        video_signed_url_stats["misses"] += 1
+
+    if storage_backend.get_blob(blob_name) is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    expires_at = now + timedelta(seconds=VIDEO_SIGNED_URL_TTL_SEC)
+    signed_url = storage_backend.signed_url(blob_name, "GET", timedelta(seconds=VIDEO_SIGNED_URL_TTL_SEC))
+    with _video_signed_url_lock:
+        _video_signed_url_cache[blob_name] = (signed_url, expires_at)
+        # 期限切れのエントリを掃除
+        for name, (_, expiry) in list(_video_signed_url_cache.items()):
+            if expiry <= now:
+                del _video_signed_url_cache[name]
+    return signed_url, expires_at
+
+def blob_stream_response(
+    blob,
+    range_header: Optional[str],
+    if_none_match: Optional[str],
+    if_range: Optional[str],
+    cache_control: str = "public, max-age=3600",  # 1時間キャッシュ
+    default_media_type: str = "video/mp4"
+) -> Response:
+    """blobを条件付きGET・Range対応でストリームするレスポンスを作る"""
+    size = blob.size
+    etag = f'"{blob.etag}"'
+    headers = {
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",  # 範囲リクエストをサポート
+        "ETag": etag
+    }
+    if blob.updated:
+        headers["Last-Modified"] = blob.updated.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    if not if_range or etag_matches(if_range, etag):
+        byte_range = parse_range_header(range_header, size)
+    
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    
+    body = iter_video_range(blob, start, end) if size else iter(())
+    
+    return StreamingResponse(
+        body,
+        status_code=status_code,
+        media_type=blob.content_type or default_media_type,
+        headers=headers
+    )
+
+@app.get("/video/{filename}")
+async def serve_video(
+    filename: str,
+    mode: Optional[str] = None,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    if_range: Optional[str] = Header(None, alias="If-Range")
+):
+    """
+    動画ファイルを提供するエンドポイント（GCSからRange単位でストリーミング）
+    mode=redirect / mode=json の場合は署名URLを返し、動画の中継はGCSに任せる
+    """
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+    
+    serve_mode = (mode or VIDEO_SERVE_MODE).lower()
+    if serve_mode not in ("proxy", "redirect", "json"):
+        raise HTTPException(status_code=400, detail=f"Unsupported mode: {serve_mode}")
+    
+    try:
+        blob_name = f"videos/{filename}"
+        
+        if serve_mode != "proxy":
+            signed_url, expires_at = await run_in_threadpool(get_video_signed_url, blob_name)
+            if serve_mode == "json":
+                return SignedVideoUrlResponse(url=signed_url, expiresAt=expires_at.isoformat() + "Z")
+            # ブラウザ側でも再署名が必要になるまでリダイレクトをキャッシュさせる
+            max_age = max(0, int((expires_at - datetime.utcnow()).total_seconds()) - VIDEO_SIGNED_URL_REFRESH_MARGIN_SEC)
+            return RedirectResponse(signed_url, status_code=302, headers={"Cache-Control": f"private, max-age={max_age}"})
+        
+        # GCSから動画のメタデータを取得（本体はダウンロードしない）
+        blob = await run_in_threadpool(storage_backend.get_blob, blob_name)
+        
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Video not found")
+        
+        return blob_stream_response(blob, range_header, if_none_match, if_range)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error serving video {filename}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to serve video: {str(e)}")
+
+@app.get("/video/{video_id}/hls/{path:path}")
+async def serve_hls(
+    video_id: str,
+    path: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    if_range: Optional[str] = Header(None, alias="If-Range")
+):
+    """
+    HLSのプレイリスト・セグメントを提供するエンドポイント（master.m3u8 から始める）
+    プレイリストは相対パスで参照するので、プレイヤーは必要なセグメントだけを取りに来る
+    """
+    if ".." in path.split("/") or "/" in video_id:
+        raise HTTPException(status_code=400, detail="Invalid HLS path")
+
+    try:
+        blob = await run_in_threadpool(storage_backend.get_blob, f"videos/{video_id}_hls/{path}")
+        if blob is None:
+            raise HTTPException(status_code=404, detail="HLS resource not found")
+        # VODなので一度作った内容は変わらない
+        return blob_stream_response(
+            blob, range_header, if_none_match, if_range,
+            cache_control="public, max-age=86400",
+            default_media_type=HLS_CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error serving HLS {video_id}/{path}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to serve HLS: {str(e)}")
+
+def verify_local_storage_request(blob_name: str, method: str, signed_method: str, expires: int, signature: str) -> None:
+    """/storage/{blob_name} の署名を検証する（local/memoryバックエンドのみ有効）"""
+    if storage_backend.name == "gcs":
+        raise HTTPException(status_code=404, detail="Not found")
+    if signed_method.upper() != method or expires < time.time():
+        raise HTTPException(status_code=403, detail="Signed URL expired or not valid for this method")
+    if not hmac.compare_digest(sign_local_storage_request(method, blob_name, expires), signature):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+@app.get("/storage/{blob_name:path}")
+async def download_local_storage_object(
+    blob_name: str,
+    method: str,
+    expires: int,
+    signature: str,
+    range_header: Optional[str] = Header(None, alias="Range")
+):
+    """local/memoryバックエンドの署名付きGET（GCSの署名URLの代わり）"""
+    verify_local_storage_request(blob_name, "GET", method, expires, signature)
+    blob = await run_in_threadpool(storage_backend.get_blob, blob_name)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Object not found")
+
+    headers = {"Accept-Ranges": "bytes", "ETag": f'"{blob.etag}"'}
+    byte_range = parse_range_header(range_header, blob.size)
+    if byte_range is None:
+        start, end, status_code = 0, blob.size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+    headers["Content-Length"] = str(end - start + 1 if blob.size else 0)
+    body = iter_blob_range(blob, start, end) if blob.size else iter(())
+    return StreamingResponse(body, status_code=status_code, media_type=blob.content_type or "application/octet-stream", headers=headers)
+
+@app.put("/storage/{blob_name:path}")
+async def upload_local_storage_object(blob_name: str, method: str, expires: int, signature: str, request: Request):
+    """local/memoryバックエンドの署名付きPUT（GCSの署名URLへの直接アップロードの代わり）"""
+    verify_local_storage_request(blob_name, "PUT", method, expires, signature)
+    MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB（GCS側のx-goog-content-length-rangeと同じ）
+
+    temp_path = UPLOAD_DIR / f"storage_put_{uuid.uuid4().hex}"
+    try:
+        total_size = 0
+        with open(temp_path, "wb") as buffer:
+            async for chunk in request.stream():
+                total_size += len(chunk)
+                if total_size > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=413, detail=f"File size exceeds {MAX_FILE_SIZE // (1024*1024)}MB limit")
+                buffer.write(chunk)
+        content_type = request.headers.get("content-type", "application/octet-stream")
+        await run_in_threadpool(storage_backend.upload_file, blob_name, str(temp_path), content_type)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    return Response(status_code=200)
+
+class ProcessResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr: str
+
+class ClientDisconnectedError(Exception):
+    """クライアント切断により外部プロセスを中断した"""
+
+# ffmpegのエンコードの同時実行数を制限する（2 vCPUのインスタンスでエンコードが奪い合わないように）
+# ffprobeやバージョン確認、gcloudなどすぐ終わるコマンドはエンコード待ちで詰まらないよう対象外にする
+_process_semaphore = asyncio.Semaphore(FFMPEG_MAX_CONCURRENCY)
+
+async def _pump_stream(stream: asyncio.StreamReader, lines: List[str], on_line=None) -> None:
+    """出力を読み取り行単位（\n または \r 区切り）でコールバックに渡す"""
+    pending = ""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        pending += chunk.decode("utf-8", errors="replace")
+        *complete, pending = pending.replace("\r", "\n").split("\n")
+        for line in complete:
+            lines.append(line)
+            if on_line and line:
+                on_line(line)
+    if pending:
+        lines.append(pending)
+        if on_line:
+            on_line(pending)
+
+async def _feed_stdin(process: asyncio.subprocess.Process, chunks) -> None:
+    """非同期イテレータのチャンクをプロセスの標準入力へ書き込み、最後に閉じる"""
+    try:
+        async for chunk in chunks:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # プロセスが先に終了した場合。結果は終了コードで判断する
+        return
+    finally:
+        if not process.stdin.is_closing():
+            process.stdin.close()
+
+async def _watch_disconnect(request: Request, process: asyncio.subprocess.Process, state: Dict[str, bool]) -> None:
+    while process.returncode is None:
+        if await request.is_disconnected():
+            state["disconnected"] = True
+            process.kill()
+            return
+        await asyncio.sleep(1.0)
+
+async def run_process(
+    cmd: List[str],
+    timeout: Optional[float] = None,
+    on_stdout_line=None,
+    on_stderr_line=None,
+    request: Optional[Request] = None,
+    limit: bool = True,
+    stdin_chunks=None
+) -> ProcessResult:
+    """
+    asyncio.create_subprocess_execで外部コマンドを実行する（イベントループをブロックしない）。
+    タイムアウト時はプロセスをkillしてsubprocess.TimeoutExpiredを送出し、
+    requestを渡した場合はクライアント切断時にkillしてClientDisconnectedErrorを送出する。
+    limit=False は呼び出し側が _process_semaphore を確保済みの場合や、エンコード以外の短いコマンドに使う。
+    stdin_chunks（bytesの非同期イテレータ）を渡すと標準入力へ流し込む。
+    行コールバックやstdin_chunksが例外を送出した場合もプロセスをkillしてから再送出する。
+    """
+    async with (_process_semaphore if limit else nullcontext()):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin_chunks is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout_lines: List[str] = []
+        stderr_lines: List[str] = []
+        state = {"disconnected": False}
+        watcher = asyncio.create_task(_watch_disconnect(request, process, state)) if request is not None else None
+
+        tasks = [
+            _pump_stream(process.stdout, stdout_lines, on_stdout_line),
+            _pump_stream(process.stderr, stderr_lines, on_stderr_line),
+            process.wait()
+        ]
+        if stdin_chunks is not None:
+            tasks.append(_feed_stdin(process, stdin_chunks))
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except BaseException:
+            # ハンドラのキャンセルやコールバックの例外でもプロセスを残さない
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+        if state["disconnected"]:
+            raise ClientDisconnectedError(f"Client disconnected, killed: {cmd[0]}")
+
+        return ProcessResult(process.returncode, "\n".join(stdout_lines), "\n".join(stderr_lines))
+
+MEDIA_INFO_METADATA_KEY = "mediaInfo"
+# GCSのカスタムメタデータは合計8KiBまで。超える場合はキーフレーム一覧を省く
+MEDIA_INFO_METADATA_MAX_BYTES = 6000
+
+def media_info_command(path: str) -> List[str]:
+    # キーフレームはパケットのフラグから取るので、デコードは発生しない
+    return [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', (
+            'format=duration,start_time'
+            ':stream=codec_name,pix_fmt,width,height,avg_frame_rate,r_frame_rate,duration'
+            ':packet=pts_time,flags'
+        ),
+        '-of', 'json', path
+    ]
+
+def _parse_float(value: Any) -> Optional[float]:
     try:
-        # 基本的なヘルスチェック
-        http2_enabled = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
-        
-        # ChromaDBの接続確認
-        chroma_status = "unknown"
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_frame_rate(value: Optional[str]) -> Optional[float]:
+    """ffprobeの "30000/1001" 形式のフレームレートを数値にする"""
+    if not value:
+        return None
+    numerator, _, denominator = value.partition("/")
+    try:
+        rate = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return rate if rate > 0 else None
+
+def parse_media_info(output: str) -> Optional[MediaInfo]:
+    """media_info_command() のJSON出力をMediaInfoにする。映像ストリームがなければNone"""
+    try:
+        payload = json.loads(output)
+    except ValueError:
+        return None
+    streams = payload.get("streams") or []
+    if not streams:
+        return None
+    stream = streams[0]
+    # -ss はファイルの開始時刻からの位置なので、キーフレームも開始時刻基準にする
+    start_time = _parse_float((payload.get("format") or {}).get("start_time")) or 0.0
+    keyframes = sorted(
+        round(pts_time - start_time, 3)
+        for packet in payload.get("packets") or []
+        if "K" in packet.get("flags", "") and (pts_time := _parse_float(packet.get("pts_time"))) is not None
+    )
+    return MediaInfo(
+        duration=_parse_float((payload.get("format") or {}).get("duration")) or _parse_float(stream.get("duration")) or 0.0,
+        fps=parse_frame_rate(stream.get("avg_frame_rate")) or parse_frame_rate(stream.get("r_frame_rate")),
+        width=stream.get("width") or 0,
+        height=stream.get("height") or 0,
+        codec=stream.get("codec_name"),
+        pixFmt=stream.get("pix_fmt"),
+        keyframes=keyframes
+    )
+
+async def probe_media_info(path: str, timeout: float = 30) -> Optional[MediaInfo]:
+    """ffprobe 1回で長さ・fps・解像度・コーデック・キーフレームを取得する。読めなければNone"""
+    result = await run_process(media_info_command(path), timeout=timeout, limit=False)
+    return parse_media_info(result.stdout) if result.returncode == 0 else None
+
+def probe_media_info_sync(path: str, timeout: float = 30) -> Optional[MediaInfo]:
+    """probe_media_info() のブロッキング版（スレッドプール内の処理用）"""
+    result = subprocess.run(media_info_command(path), capture_output=True, text=True, timeout=timeout)
+    return parse_media_info(result.stdout) if result.returncode == 0 else None
+
+def media_info_metadata(media_info: Optional[MediaInfo]) -> Optional[Dict[str, str]]:
+    """オブジェクトメタデータとして保存する形にする"""
+    if media_info is None:
+        return None
+    payload = jsonable_encoder(media_info)
+    encoded = json.dumps(payload, separators=(",", ":"))
+    if len(encoded) > MEDIA_INFO_METADATA_MAX_BYTES:
+        encoded = json.dumps(dict(payload, keyframes=[]), separators=(",", ":"))
+    return {MEDIA_INFO_METADATA_KEY: encoded}
+
+def media_info_from_metadata(metadata: Optional[Dict[str, str]]) -> Optional[MediaInfo]:
+    value = (metadata or {}).get(MEDIA_INFO_METADATA_KEY)
+    if not value:
+        return None
+    try:
+        return MediaInfo(**json.loads(value))
+    except (ValueError, TypeError):
+        return None
+
+# メタデータを持たない（古い・直接アップロードされた）blob用: (blob名, generation) -> MediaInfo
+_media_info_cache: "OrderedDict[Tuple[str, int], MediaInfo]" = OrderedDict()
+_media_info_lock = threading.Lock()
+media_info_stats = {"metadataHits": 0, "cacheHits": 0, "probes": 0}
+
+def get_media_info(blob, local_path: str) -> MediaInfo:
+    """blobのメディア情報を オブジェクトメタデータ → プロセス内キャッシュ → ffprobe の順に取得する"""
+    media_info = media_info_from_metadata(getattr(blob, "metadata", None))
+    if media_info is not None:
+        with _media_info_lock:
+            media_info_stats["metadataHits"] += 1
+        return media_info
+
+    key = (blob.name, blob.generation)
+    with _media_info_lock:
+        media_info = _media_info_cache.get(key)
+        if media_info is not None:
+            _media_info_cache.move_to_end(key)
+            media_info_stats["cacheHits"] += 1
+            return media_info
+
+        media_info_stats["probes"] += 1
+    media_info = probe_media_info_sync(local_path)
+    if media_info is None:
+        raise HTTPException(status_code=400, detail="Could not read video file")
+    with _media_info_lock:
+        _media_info_cache[key] = media_info
+        while len(_media_info_cache) > MEDIA_INFO_CACHE_SIZE:
+            _media_info_cache.popitem(last=False)
+    return media_info
+
+class FFmpegProgressParser:
+    """ffmpeg -progress の key=value 出力を解析し、progress= 行ごとに進捗を通知する"""
+
+    def __init__(self, total_sec: Optional[float], on_progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.total_sec = total_sec
+        self.on_progress = on_progress
+        self.last: Dict[str, Any] = {}
+        self._fields: Dict[str, str] = {}
+
+    def feed(self, line: str) -> None:
+        key, sep, value = line.partition("=")
+        if not sep:
+            return
+        key, value = key.strip(), value.strip()
+        if key != "progress":
+            self._fields[key] = value
+            return
+        self.last = self._snapshot(done=value == "end")
+        self._fields = {}
+        if self.on_progress:
+            self.on_progress(self.last)
+
+    @staticmethod
+    def _number(value: Optional[str]) -> Optional[float]:
+        # speed は "2.3x"、未確定の値は "N/A" で出力される
         try:
-            vectorstore = get_langchain_chroma_vectorstore()
-            count = vectorstore._collection.count()
-            chroma_status = f"connected ({count} items)"
-        except Exception:
-            chroma_status = "disconnected"
-        
+            return float(value.rstrip("x")) if value else None
+        except ValueError:
+            return None
+
+    def _snapshot(self, done: bool) -> Dict[str, Any]:
+        # out_time_ms は名前に反してマイクロ秒単位（out_time_us と同じ値）
+        out_time_us = self._number(self._fields.get("out_time_ms") or self._fields.get("out_time_us"))
+        out_time_sec = max(out_time_us or 0.0, 0.0) / 1_000_000
+        if done:
+            fraction = 1.0
+        elif self.total_sec:
+            fraction = min(out_time_sec / self.total_sec, 1.0)
+        else:
+            fraction = 0.0
         return {
-            "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
-            "http2_enabled": http2_enabled,
-            "chroma_status": chroma_status,
-            "server": "hypercorn"
+            "outTimeSec": round(out_time_sec, 2),
+            "totalSec": self.total_sec,
+            "fraction": round(fraction, 3),
+            "speed": self._number(self._fields.get("speed")),
+            "fps": self._number(self._fields.get("fps")),
+            "done": done,
         }
-    except Exception as e:
+
+class EncodeSpeedStats:
+    """プリセットごとのエンコード速度（実時間比）を記録する。プリセット調整の材料にする"""
+
+    def __init__(self, max_samples: int = 200):
+        self._samples: Dict[str, deque] = {}
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+
+    def record(self, preset: str, speed: float) -> None:
+        with self._lock:
+            self._samples.setdefault(preset, deque(maxlen=self._max_samples)).append(speed)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            samples = {preset: sorted(values) for preset, values in self._samples.items()}
         return {
-            "status": "unhealthy",
-            "error": str(e),
-            "timestamp": datetime.now().isoformat()
+            preset: {
+                "count": len(values),
+                "avgSpeed": round(sum(values) / len(values), 2),
+                "p50Speed": values[len(values) // 2],
+                "minSpeed": values[0],
+                "maxSpeed": values[-1],
+            }
+            for preset, values in samples.items() if values
         }
 
-@app.get("/video/{filename}")
-async def serve_video(filename: str):
-    """動画ファイルを提供するエンドポイント"""
-    if not GCS_BUCKET_NAME:
-        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
-    
+encode_speed_stats = EncodeSpeedStats()
+
+def is_remux_compatible(media_info: MediaInfo) -> bool:
+    """再エンコードせずに配信できる映像ストリームか（H.264 / yuv420p / 720p以下 / 30fps以下）"""
+    return (
+        media_info.codec == "h264"
+        and media_info.pixFmt == "yuv420p"
+        and 0 < media_info.width <= OPTIMIZED_WIDTH
+        and 0 < media_info.height <= OPTIMIZED_HEIGHT
+        and media_info.fps is not None
+        and media_info.fps <= OPTIMIZED_FPS + 0.5  # 29.97/30.0 の揺らぎを許容
+    )
+
+def build_optimize_command(
+    input_path: str,
+    output_path: str,
+    max_duration: Optional[float],
+    processing_path: str,
+    segment: Optional[Tuple[float, float]] = None,
+    threads: int = 0
+) -> List[str]:
+    """
+    最適化用のffmpegコマンド。segment=(開始秒, 長さ) を指定するとその区間だけをエンコードする。
+    max_duration=None では長さを制限しない（呼び出し側が進捗を見て打ち切る）。
+    """
+    if processing_path == "remux":
+        return [
+            'ffmpeg', '-nostats', '-progress', 'pipe:1',
+            '-i', input_path,
+            '-map', '0:v:0',
+            '-c:v', 'copy',     # 映像はそのままコピー
+            '-an',              # Remove audio
+            '-t', str(max_duration),
+            '-movflags', '+faststart',
+            '-y',
+            output_path
+        ]
+    # 区間はキーフレーム位置から始まるので、入力側シークでも境界のフレームは欠けない
+    seek = ['-ss', f"{segment[0]:.3f}"] if segment else []
+    if segment:
+        duration = ['-t', f"{segment[1]:.3f}"]
+    else:
+        duration = ['-t', str(max_duration)] if max_duration is not None else []
+    # 区間ファイルは後で結合する際にfaststartにするので、ここでは付けない
+    faststart = [] if segment else ['-movflags', '+faststart']  # Optimize for web streaming
+    # 動作確認済み設定に戻す（HTTP/2対応版）
+    return [
+        'ffmpeg', '-nostats', '-progress', 'pipe:1',  # 進捗をkey=value形式で標準出力へ
+        *seek,
+        '-i', input_path,
+        '-c:v', 'libx264',  # H.264 codec
+        '-crf', '28',       # Constant Rate Factor for quality vs size balance
+        '-preset', OPTIMIZE_PRESET,  # Use fast preset for better performance
+        '-vf', f'scale={OPTIMIZED_WIDTH}:{OPTIMIZED_HEIGHT}:force_original_aspect_ratio=decrease,pad={OPTIMIZED_WIDTH}:{OPTIMIZED_HEIGHT}:(ow-iw)/2:(oh-ih)/2,fps={OPTIMIZED_FPS}',  # Enhanced scaling
+        '-r', str(OPTIMIZED_FPS),  # Frame rate
+        '-an',              # Remove audio
+        *duration,          # Limit duration
+        *faststart,
+        '-threads', str(threads),  # 0: Use all available CPU threads
+        '-y',               # Overwrite output file
+        output_path
+    ]
+
+@lru_cache(maxsize=1)
+def get_cpu_quota() -> int:
+    """コンテナに割り当てられたCPU数（cgroupのクォータ。なければ利用可能なコア数）"""
     try:
-        # GCSから動画ファイルを取得
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob_name = f"videos/{filename}"
-        blob = bucket.blob(blob_name)
-        
-        if not blob.exists():
-            raise HTTPException(status_code=404, detail="Video not found")
-        
-        # 一時ファイルにダウンロード
-        temp_path = UPLOAD_DIR / filename
-        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        
-        blob.download_to_filename(str(temp_path))
-        
-        # ファイルを提供
-        return FileResponse(
-            temp_path, 
-            media_type="video/mp4",
-            headers={
-                "Cache-Control": "public, max-age=3600",  # 1時間キャッシュ
-                "Accept-Ranges": "bytes"  # 範囲リクエストをサポート
-            }
-        )
-        
-    except Exception as e:
-        logger.error(f"Error serving video {filename}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to serve video: {str(e)}")
+        # cgroup v2: "200000 100000" または "max 100000"
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return max(1, int(quota) // int(period))
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def plan_segments(media_info: MediaInfo, max_duration: float, count: int) -> List[Tuple[float, float]]:
+    """
+    入力をキーフレーム位置で最大count個の (開始秒, 長さ) に分割する。
+    各区間はSEGMENT_MIN_DURATION_SEC以上になるようにし、分割できなければ1区間を返す。
+    """
+    total = min(media_info.duration, max_duration)
+    boundaries = [0.0]
+    keyframes = [k for k in media_info.keyframes if 0 < k < total]
+    for i in range(1, count):
+        if not keyframes:
+            break
+        target = total * i / count
+        nearest = min(keyframes, key=lambda k: abs(k - target))
+        if nearest - boundaries[-1] >= SEGMENT_MIN_DURATION_SEC and total - nearest >= SEGMENT_MIN_DURATION_SEC:
+            boundaries.append(nearest)
+    boundaries.append(total)
+    return [(start, end - start) for start, end in zip(boundaries, boundaries[1:])]
+
+async def run_segmented_transcode(
+    input_path: str,
+    output_path: str,
+    segments: List[Tuple[float, float]],
+    request: Optional[Request] = None,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> float:
+    """
+    区間ごとに同じ設定でffmpegを並列実行し、concat demuxerで1本のfaststart MP4に結合する。
+    並列プロセス全体で _process_semaphore を1つ使う。戻り値はエンコード速度（実時間比）。
+    """
+    work_dir = Path(f"{output_path}.segments")
+    work_dir.mkdir(parents=True, exist_ok=True)
+    segment_paths = [work_dir / f"segment_{index:03d}.mp4" for index in range(len(segments))]
+    threads = max(1, get_cpu_quota() // len(segments))
+    total_sec = sum(duration for _, duration in segments)
+    encoded_sec = [0.0] * len(segments)
+
+    def segment_progress(index: int) -> Callable[[Dict[str, Any]], None]:
+        def on_segment_progress(info: Dict[str, Any]) -> None:
+            encoded_sec[index] = segments[index][1] if info["done"] else min(info["outTimeSec"], segments[index][1])
+            if on_progress:
+                done_sec = sum(encoded_sec)
+                on_progress({
+                    "outTimeSec": round(done_sec, 2),
+                    "totalSec": total_sec,
+                    "fraction": round(min(done_sec / total_sec, 1.0), 3) if total_sec else 0.0,
+                    "speed": None,
+                    "fps": None,
+                    "done": False,
+                    "segments": len(segments),
+                })
+        return on_segment_progress
+
+    start_time = time.perf_counter()
+    try:
+        async with _process_semaphore:
+            tasks = [
+                asyncio.ensure_future(run_process(
+                    build_optimize_command(input_path, str(path), total_sec, "transcode", segment=segment, threads=threads),
+                    timeout=300,
+                    on_stdout_line=FFmpegProgressParser(segment[1], segment_progress(index)).feed,
+                    on_stderr_line=lambda line: logger.debug(f"FFmpeg: {line}"),
+                    request=request,
+                    limit=False
+                ))
+                for index, (segment, path) in enumerate(zip(segments, segment_paths))
+            ]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # 1区間でも失敗したら残りのプロセスも止める
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            for index, result in enumerate(results):
+                if result.returncode != 0:
+                    raise Exception(f"Segment {index} encode failed (code {result.returncode}): {result.stderr}")
+
+            list_path = work_dir / "segments.txt"
+            list_path.write_text("".join(f"file '{path.name}'\n" for path in segment_paths))
+            concat = await run_process([
+                'ffmpeg', '-nostats', '-v', 'error',
+                '-f', 'concat', '-safe', '0', '-i', str(list_path),
+                '-c', 'copy',
+                '-movflags', '+faststart',
+                '-y', output_path
+            ], timeout=120, request=request, limit=False)
+            if concat.returncode != 0:
+                raise Exception(f"Segment concat failed (code {concat.returncode}): {concat.stderr}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - start_time
+    speed = round(total_sec / elapsed, 3) if elapsed > 0 else None
+    if on_progress:
+        on_progress({
+            "outTimeSec": round(total_sec, 2), "totalSec": total_sec, "fraction": 1.0,
+            "speed": speed, "fps": None, "done": True, "segments": len(segments),
+        })
+    logger.info(f"Segmented transcode: {len(segments)} segments x {threads} threads in {elapsed:.1f}s")
+    return speed
 
 # Video optimization functions with enhanced performance
-def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float = 30.0) -> Dict[str, Any]:
+async def optimize_video_ffmpeg(
+    input_path: str,
+    output_path: str,
+    max_duration: float = 30.0,
+    request: Optional[Request] = None,
+    media_info: Optional[MediaInfo] = None,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    allow_remux: bool = REMUX_FAST_PATH,
+    transcode_mode: Optional[str] = None
+) -> Dict[str, Any]:
     """
     Optimize video using FFmpeg with ultra-lightweight settings for debugging
+
+    media_info には呼び出し側で取得済みの入力のメディア情報を渡す（なければここでffprobeする）。
+    on_progress には ffmpeg -progress から解析した進捗（outTimeSec, fraction, speed, fps）が渡される。
+    戻り値の mediaInfo は出力ファイルのメディア情報。
     """
     try:
         # 入力ファイルの存在確認
@@ -1081,44 +3506,69 @@ def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir, exist_ok=True)
         
-        # 動作確認済み設定に戻す（HTTP/2対応版）
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264',  # H.264 codec
-            '-crf', '28',       # Constant Rate Factor for quality vs size balance
-            '-preset', 'fast',  # Use fast preset for better performance
-            '-vf', f'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2,fps=30',  # Enhanced scaling
-            '-r', '30',         # Frame rate
-            '-an',              # Remove audio
-            '-t', str(max_duration),  # Limit duration
-            '-movflags', '+faststart',  # Optimize for web streaming
-            '-threads', '0',    # Use all available CPU threads
-            '-y',               # Overwrite output file
-            output_path
-        ]
+        # 配信条件を満たす入力は再エンコードせず、コンテナだけ作り直す
+        if media_info is None:
+            media_info = await probe_media_info(input_path)
+        processing_path = "remux" if allow_remux and media_info and is_remux_compatible(media_info) else "transcode"
+        transcode_mode = transcode_mode or TRANSCODE_MODE
         
         # 詳細ログ出力
         logger.info(f"=== FFmpeg Processing Start ===")
         logger.info(f"Input file: {input_path}")
         logger.info(f"Output file: {output_path}")
         logger.info(f"Input file size: {os.path.getsize(input_path)} bytes")
+        logger.info(f"Input media info: {media_info}")
+        logger.info(f"Processing path: {processing_path}")
         logger.info(f"Max duration: {max_duration} seconds")
-        logger.info(f"FFmpeg command: {' '.join(cmd)}")
         
-        # FFmpeg実行（タイムアウト300秒）
-        logger.info("Starting FFmpeg execution...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        logger.info(f"FFmpeg execution completed with return code: {result.returncode}")
+        total_sec = min(media_info.duration, max_duration) if media_info and media_info.duration else max_duration
         
-        # 標準出力・エラー出力をログ
-        if result.stdout:
-            logger.info(f"FFmpeg stdout: {result.stdout}")
-        if result.stderr:
-            logger.info(f"FFmpeg stderr: {result.stderr}")
+        async def run_ffmpeg(path: str) -> Tuple[ProcessResult, FFmpegProgressParser]:
+            cmd = build_optimize_command(input_path, output_path, max_duration, path)
+            logger.info(f"FFmpeg command: {' '.join(cmd)}")
+            parser = FFmpegProgressParser(total_sec, on_progress)
+            # FFmpeg実行（タイムアウト300秒）
+            result = await run_process(
+                cmd,
+                timeout=300,
+                on_stdout_line=parser.feed,
+                on_stderr_line=lambda line: logger.debug(f"FFmpeg: {line}"),
+                request=request
+            )
+            logger.info(f"FFmpeg execution completed with return code: {result.returncode}")
+            # 標準出力は進捗情報なので、エラー出力だけをログ
+            if result.stderr:
+                logger.info(f"FFmpeg stderr: {result.stderr}")
+            return result, parser
         
-        if result.returncode != 0:
-            logger.error(f"FFmpeg failed with return code: {result.returncode}")
-            raise Exception(f"FFmpeg failed (code {result.returncode}): {result.stderr}")
+        encode_speed = None
+        segment_count = 1
+        if processing_path == "transcode" and transcode_mode == "segmented" and media_info:
+            segments = plan_segments(media_info, max_duration, TRANSCODE_SEGMENTS or get_cpu_quota())
+            if len(segments) > 1:
+                logger.info(f"Starting segmented FFmpeg execution: {segments}")
+                try:
+                    encode_speed = await run_segmented_transcode(input_path, output_path, segments, request, on_progress)
+                    segment_count = len(segments)
+                except (ClientDisconnectedError, subprocess.TimeoutExpired):
+                    raise
+                except Exception as e:
+                    logger.warning(f"Segmented transcode failed, falling back to single process: {e}")
+        
+        if segment_count == 1:
+            logger.info("Starting FFmpeg execution...")
+            result, progress = await run_ffmpeg(processing_path)
+            
+            if result.returncode != 0 and processing_path == "remux":
+                # コンテナの都合でコピーできない入力もあるため、再エンコードでやり直す
+                logger.warning(f"Remux failed (code {result.returncode}), falling back to transcode")
+                processing_path = "transcode"
+                result, progress = await run_ffmpeg(processing_path)
+            
+            if result.returncode != 0:
+                logger.error(f"FFmpeg failed with return code: {result.returncode}")
+                raise Exception(f"FFmpeg failed (code {result.returncode}): {result.stderr}")
+            encode_speed = progress.last.get("speed")
         
         # 出力ファイルの存在確認
         if not os.path.exists(output_path):
@@ -1133,17 +3583,13 @@ def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float
         
         compression_ratio = ((original_size - optimized_size) / original_size) * 100
         
-        # 簡単な動画時間取得（エラーが起きても処理を続行）
+        # 出力のメディア情報を取得し、保存時のメタデータにも使う（エラーが起きても処理を続行）
         try:
-            duration_cmd = [
-                'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1', output_path
-            ]
-            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True, timeout=10)
-            duration = float(duration_result.stdout.strip()) if duration_result.returncode == 0 and duration_result.stdout.strip() else max_duration
+            output_media_info = await probe_media_info(output_path, timeout=10)
         except Exception as e:
-            logger.warning(f"Failed to get video duration: {e}")
-            duration = max_duration
+            logger.warning(f"Failed to probe optimized video: {e}")
+            output_media_info = None
+        duration = output_media_info.duration if output_media_info and output_media_info.duration else max_duration
         
         logger.info(f"=== FFmpeg Processing Success ===")
         logger.info(f"Original size: {original_size} bytes")
@@ -1151,12 +3597,23 @@ def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float
         logger.info(f"Compression ratio: {compression_ratio:.1f}%")
         logger.info(f"Duration: {duration} seconds")
         
+        if encode_speed:
+            speed_key = OPTIMIZE_PRESET if processing_path == "transcode" else processing_path
+            if segment_count > 1:
+                speed_key = f"{speed_key}-segmented"
+            encode_speed_stats.record(speed_key, encode_speed)
+            logger.info(f"Encode speed: {encode_speed}x ({speed_key})")
+        
         return {
             'success': True,
             'originalSize': original_size,
             'optimizedSize': optimized_size,
             'compressionRatio': compression_ratio,
             'optimizedDuration': duration,
+            'encodeSpeed': encode_speed,
+            'processingPath': processing_path,
+            'segments': segment_count,
+            'mediaInfo': output_media_info,
             'message': f'Video optimized successfully. Reduced size by {compression_ratio:.1f}%'
         }
         
@@ -1165,6 +3622,10 @@ def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float
         if os.path.exists(output_path):
             os.remove(output_path)
         raise Exception("Video processing timed out. Please try with a shorter video.")
+    except asyncio.CancelledError:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
     except Exception as e:
         logger.error(f"FFmpeg processing failed: {str(e)}")
         # Clean up on error
@@ -1172,49 +3633,295 @@ def optimize_video_ffmpeg(input_path: str, output_path: str, max_duration: float
             os.remove(output_path)
         raise Exception(f"Video optimization failed: {str(e)}")
 
-# Memory-efficient video processing for ranges
-def extract_video_range_optimized(input_path: str, output_path: str, start_time: float, duration: float) -> Dict[str, Any]:
+# Analysis proxy rendition
+def analysis_proxy_blob_name(blob_name: str) -> str:
+    """最適化済み動画の隣に置く分析用プロキシのblob名（videos/{id}_optimized.mp4 → videos/{id}_proxy.mp4）"""
+    stem, _ = os.path.splitext(blob_name)
+    return f"{stem.removesuffix('_optimized')}_proxy.mp4"
+
+async def create_analysis_proxy(input_path: str, output_path: str) -> Dict[str, Any]:
     """
-    Extract a specific time range from video with memory optimization
+    範囲分析用の低解像度・短GOPのプロキシを作る。
+    キーフレームがANALYSIS_PROXY_GOP_SEC間隔で並ぶので、どこへシークしてもデコードが短く済む。
     """
+    gop_frames = max(1, round(ANALYSIS_PROXY_GOP_SEC * OPTIMIZED_FPS))
+    cmd = [
+        'ffmpeg', '-nostats', '-v', 'error',
+        '-i', input_path,
+        '-c:v', 'libx264',
+        '-crf', '23',            # Slightly better quality for analysis
+        '-preset', 'veryfast',   # Fastest encoding for range extraction
+        '-vf', (
+            f'scale={ANALYSIS_PROXY_WIDTH}:{ANALYSIS_PROXY_HEIGHT}:force_original_aspect_ratio=decrease,'
+            f'pad={ANALYSIS_PROXY_WIDTH}:{ANALYSIS_PROXY_HEIGHT}:(ow-iw)/2:(oh-ih)/2'
+        ),  # Lower resolution for faster processing
+        '-r', str(OPTIMIZED_FPS),
+        '-g', str(gop_frames),   # 固定GOP（シーンチェンジでの追加キーフレームなし）
+        '-keyint_min', str(gop_frames),
+        '-sc_threshold', '0',
+        '-an',                   # Remove audio
+        '-movflags', '+faststart',
+        '-threads', '0',
+        '-y',
+        output_path
+    ]
+
     try:
-        # Use seek before input for better performance
-        cmd = [
-            'ffmpeg',
-            '-ss', str(start_time),  # Seek to start time (before input for better performance)
-            '-i', input_path,
-            '-t', str(duration),     # Duration to extract
-            '-c:v', 'libx264',
-            '-crf', '23',            # Slightly better quality for analysis
-            '-preset', 'veryfast',   # Fastest encoding for range extraction
-            '-vf', 'scale=854:480:force_original_aspect_ratio=decrease,pad=854:480:(ow-iw)/2:(oh-ih)/2',  # Lower resolution for faster processing
-            '-r', '30',
-            '-an',                   # Remove audio
-            '-movflags', '+faststart',
-            '-threads', '0',
-            '-y',
-            output_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)  # 2 minute timeout for range extraction
-        
+        result = await run_process(cmd, timeout=120)  # 2 minute timeout for proxy creation
         if result.returncode != 0:
-            raise Exception(f"Range extraction failed: {result.stderr}")
-        
-        file_size = os.path.getsize(output_path)
-        
-        return {
-            'success': True,
-            'size': file_size,
-            'message': f'Range extracted successfully ({duration:.1f}s from {start_time:.1f}s)'
-        }
-        
+            raise Exception(result.stderr)
     except subprocess.TimeoutExpired:
-        raise Exception("Range extraction timed out.")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise Exception("Analysis proxy creation timed out.")
     except Exception as e:
         if os.path.exists(output_path):
             os.remove(output_path)
-        raise Exception(f"Range extraction failed: {str(e)}")
+        raise Exception(f"Analysis proxy creation failed: {str(e)}")
+
+    return {
+        'success': True,
+        'size': os.path.getsize(output_path),
+        'mediaInfo': await probe_media_info(output_path, timeout=10)
+    }
+
+async def store_analysis_proxy(optimized_path: Path, blob_name: str) -> None:
+    """最適化済み動画から分析用プロキシを作って保存する。失敗しても取り込み自体は止めない"""
+    proxy_path = optimized_path.with_name(f"{optimized_path.stem}_proxy.mp4")
+    proxy_blob_name = analysis_proxy_blob_name(blob_name)
+    try:
+        proxy = await create_analysis_proxy(str(optimized_path), str(proxy_path))
+        await run_in_threadpool(
+            storage_backend.upload_file, proxy_blob_name, str(proxy_path), "video/mp4",
+            media_info_metadata(proxy['mediaInfo'])
+        )
+        logger.info(f"Analysis proxy stored: {proxy_blob_name} ({proxy['size']} bytes)")
+    except Exception as e:
+        logger.warning(f"Analysis proxy for {blob_name} was not created: {e}")
+    finally:
+        if proxy_path.exists():
+            proxy_path.unlink()
+
+# Precomputed frame store
+FRAME_INDEX_METADATA_KEY = "frameIndex"
+
+def frame_store_blob_name(blob_name: str) -> str:
+    """最適化済み動画に対応するフレームストアのblob名（videos/{id}_optimized.mp4 → videos/{id}_frames.bin）"""
+    stem, _ = os.path.splitext(blob_name)
+    return f"{stem.removesuffix('_optimized')}_frames.bin"
+
+async def create_frame_store(input_path: str, work_dir: Path) -> Tuple[Path, Dict[str, Any]]:
+    """
+    FRAME_STORE_FPS間隔でフレームを抽出してJPEGにし、1つのファイルに連結する。
+    戻り値は (連結ファイル, インデックス)。i番目のフレームは時刻 i / fps で、
+    バイト範囲は offsets[i] 〜 offsets[i + 1] - 1。
+    """
+    frames_dir = work_dir / "frames"
+    frames_dir.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        'ffmpeg', '-nostats', '-v', 'error',
+        '-i', input_path,
+        '-an',
+        '-vf', (
+            f"fps={FRAME_STORE_FPS},"
+            f"scale={GEMINI_FRAME_WIDTH}:{GEMINI_FRAME_HEIGHT}:force_original_aspect_ratio=decrease,"
+            f"pad={GEMINI_FRAME_WIDTH}:{GEMINI_FRAME_HEIGHT}:(ow-iw)/2:(oh-ih)/2"
+        ),
+        '-q:v', str(FRAME_STORE_JPEG_QSCALE),
+        '-f', 'image2',
+        str(frames_dir / "%05d.jpg")
+    ]
+    result = await run_process(cmd, timeout=120)
+    if result.returncode != 0:
+        raise Exception(f"Frame extraction failed (code {result.returncode}): {result.stderr}")
+
+    pack_path = work_dir / "frames.bin"
+    offsets = [0]
+    with open(pack_path, "wb") as pack:
+        for frame_path in sorted(frames_dir.glob("*.jpg")):
+            data = frame_path.read_bytes()
+            pack.write(data)
+            offsets.append(offsets[-1] + len(data))
+    if len(offsets) < 2:
+        raise Exception("No frames extracted")
+    return pack_path, {"fps": FRAME_STORE_FPS, "offsets": offsets}
+
+async def store_frame_store(optimized_path: Path, blob_name: str) -> None:
+    """最適化済み動画からフレームストアを作って保存する。失敗しても取り込み自体は止めない"""
+    work_dir = optimized_path.with_name(f"{optimized_path.stem}_frames")
+    store_blob_name = frame_store_blob_name(blob_name)
+    try:
+        pack_path, index = await create_frame_store(str(optimized_path), work_dir)
+        encoded_index = json.dumps(index, separators=(",", ":"))
+        if len(encoded_index) > MEDIA_INFO_METADATA_MAX_BYTES:
+            raise Exception(f"Frame index too large for object metadata ({len(encoded_index)} bytes)")
+        await run_in_threadpool(
+            storage_backend.upload_file, store_blob_name, str(pack_path), "application/octet-stream",
+            {FRAME_INDEX_METADATA_KEY: encoded_index}
+        )
+        logger.info(f"Frame store saved: {store_blob_name} ({len(index['offsets']) - 1} frames, {index['offsets'][-1]} bytes)")
+    except Exception as e:
+        logger.warning(f"Frame store for {blob_name} was not created: {e}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def select_stored_frame_indices(index: Dict[str, Any], start_sec: float, end_sec: float) -> List[int]:
+    """extract_analysis_framesと同じく、ANALYSIS_INTERVAL_SEC間隔の候補から最大MAX_FRAMES_FOR_GEMINI枚を選ぶ"""
+    fps = index["fps"]
+    frame_count = len(index["offsets"]) - 1
+    if end_sec < start_sec or frame_count <= 0:
+        return []
+    candidate_count = int((end_sec - start_sec) / ANALYSIS_INTERVAL_SEC) + 1
+    candidates = [
+        min(frame_count - 1, round((start_sec + i * ANALYSIS_INTERVAL_SEC) * fps))
+        for i in range(candidate_count)
+    ]
+    return sorted({candidates[i] for i in select_sample_indices(len(candidates), MAX_FRAMES_FOR_GEMINI)})
+
+def load_stored_frames(blob_name: str, start_sec: float, end_sec: float) -> Optional[Tuple[list, List[float]]]:
+    """
+    フレームストアから指定範囲の分析用フレームを読み出す（ブロッキング）。(フレーム, 各フレームの時刻（秒）) を返す。
+    使うフレームを含むバイト範囲だけをローカルキャッシュまたはレンジ読み出しで取得する。
+    フレームストアがなければNone。
+    """
+    if not FRAME_STORE_ENABLED:
+        return None
+    store_blob = storage_backend.get_blob(frame_store_blob_name(blob_name))
+    if store_blob is None:
+        return None
+    try:
+        index = json.loads((store_blob.metadata or {})[FRAME_INDEX_METADATA_KEY])
+    except (KeyError, ValueError):
+        logger.warning(f"Frame store {store_blob.name} has no usable index")
+        return None
+
+    selected = select_stored_frame_indices(index, start_sec, end_sec)
+    if not selected:
+        return None
+    offsets = index["offsets"]
+    span_start, span_end = offsets[selected[0]], offsets[selected[-1] + 1] - 1
+
+    local_path = video_cache.lookup(store_blob)
+    if local_path is not None:
+        try:
+            with open(local_path, "rb") as f:
+                f.seek(span_start)
+                data = f.read(span_end - span_start + 1)
+        finally:
+            video_cache.release(local_path)
+    else:
+        data = storage_backend.read_range(store_blob.name, span_start, span_end, generation=store_blob.generation)
+
+    frames, frame_times = [], []
+    view = memoryview(data)
+    for frame_index in selected:
+        jpeg = np.frombuffer(view[offsets[frame_index] - span_start:offsets[frame_index + 1] - span_start], dtype=np.uint8)
+        frame = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+        if frame is not None:
+            frames.append(frame)
+            frame_times.append(frame_index / index["fps"])
+    logger.info(f"Loaded {len(frames)} frames from {store_blob.name} ({len(data)} bytes read)")
+    return frames, frame_times
+
+# HLS (fMP4) preview renditions
+HLS_MASTER_PLAYLIST = "master.m3u8"
+HLS_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+
+def hls_prefix(blob_name: str) -> str:
+    """最適化済み動画に対応するHLS一式のプレフィックス（videos/{id}_optimized.mp4 → videos/{id}_hls）"""
+    stem, _ = os.path.splitext(blob_name)
+    return f"{stem.removesuffix('_optimized')}_hls"
+
+def build_hls_command(input_path: str, output_dir: Path) -> List[str]:
+    """
+    低ビットレートのプレビュー（固定GOPで再エンコード）と分析用（最適化済み映像をそのままコピー）の
+    2レンディションをfMP4のHLSとして書き出すコマンド。分析用のセグメント境界は元のキーフレームになる。
+    """
+    gop_frames = max(1, round(HLS_SEGMENT_SEC * OPTIMIZED_FPS))
+    return [
+        'ffmpeg', '-nostats', '-v', 'error',
+        '-i', input_path,
+        '-map', '0:v:0', '-map', '0:v:0',
+        '-c:v:0', 'libx264',
+        '-filter:v:0', (
+            f'scale={HLS_PREVIEW_WIDTH}:{HLS_PREVIEW_HEIGHT}:force_original_aspect_ratio=decrease,'
+            f'pad={HLS_PREVIEW_WIDTH}:{HLS_PREVIEW_HEIGHT}:(ow-iw)/2:(oh-ih)/2'
+        ),
+        '-b:v:0', HLS_PREVIEW_BITRATE,
+        '-maxrate:v:0', HLS_PREVIEW_BITRATE,
+        '-bufsize:v:0', HLS_PREVIEW_BITRATE,
+        '-preset:v:0', 'veryfast',
+        '-g:v:0', str(gop_frames),  # セグメントごとにキーフレームを置く
+        '-keyint_min:v:0', str(gop_frames),
+        '-sc_threshold:v:0', '0',
+        '-c:v:1', 'copy',
+        '-an',
+        '-f', 'hls',
+        '-hls_time', str(HLS_SEGMENT_SEC),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_type', 'fmp4',
+        '-hls_segment_filename', str(output_dir / "%v" / "seg_%03d.m4s"),
+        '-master_pl_name', HLS_MASTER_PLAYLIST,
+        '-var_stream_map', 'v:0,name:preview v:1,name:analysis',
+        '-y',
+        str(output_dir / "%v" / "index.m3u8")
+    ]
+
+async def store_hls_renditions(optimized_path: Path, blob_name: str) -> Optional[str]:
+    """
+    最適化済み動画からHLS一式を作って保存し、マスタープレイリストのblob名を返す。
+    失敗しても取り込み自体は止めずにNoneを返す。
+    """
+    work_dir = optimized_path.with_name(f"{optimized_path.stem}_hls")
+    prefix = hls_prefix(blob_name)
+    try:
+        result = await run_process(build_hls_command(str(optimized_path), work_dir), timeout=120)
+        if result.returncode != 0:
+            raise Exception(f"HLS packaging failed (code {result.returncode}): {result.stderr}")
+
+        def upload(path: Path):
+            return run_in_threadpool(
+                storage_backend.upload_file,
+                f"{prefix}/{path.relative_to(work_dir).as_posix()}",
+                str(path),
+                HLS_CONTENT_TYPES.get(path.suffix, "application/octet-stream")
+            )
+
+        # セグメントを並行して置いてから、それを参照するプレイリスト、最後にマスタープレイリストを置く
+        files = [path for path in work_dir.rglob("*") if path.is_file()]
+        await asyncio.gather(*(upload(path) for path in files if path.suffix != ".m3u8"))
+        await asyncio.gather(*(upload(path) for path in files if path.suffix == ".m3u8" and path.name != HLS_MASTER_PLAYLIST))
+        await upload(work_dir / HLS_MASTER_PLAYLIST)
+        logger.info(f"HLS renditions stored under {prefix}/ ({len(files)} files)")
+        return f"{prefix}/{HLS_MASTER_PLAYLIST}"
+    except Exception as e:
+        logger.warning(f"HLS renditions for {blob_name} were not created: {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+async def store_optimized_video(optimized_path: Path, blob_name: str, media_info: Optional[MediaInfo]) -> Optional[str]:
+    """
+    最適化済み動画を保存する。並行して分析用プロキシ・フレームストア・HLSも作り、隣に保存する。
+    HLSを保存できた場合はマスタープレイリストのblob名を返す。
+    """
+    tasks = [run_in_threadpool(
+        storage_backend.upload_file, blob_name, str(optimized_path), "video/mp4",
+        media_info_metadata(media_info)
+    )]
+    if ANALYSIS_PROXY_ENABLED:
+        tasks.append(store_analysis_proxy(optimized_path, blob_name))
+    if FRAME_STORE_ENABLED:
+        tasks.append(store_frame_store(optimized_path, blob_name))
+    if HLS_ENABLED:
+        hls_manifest, *_ = await asyncio.gather(store_hls_renditions(optimized_path, blob_name), *tasks)
+        return hls_manifest
+    await asyncio.gather(*tasks)
+    return None
 
 # Add explicit OPTIONS handler for preflight requests
 @app.options("/{path:path}")
@@ -1259,16 +3966,11 @@ async def generate_signed_url(request: SignedUrlRequest):
         file_extension = Path(request.filename).suffix or '.mp4'
         gcs_blob_name = f"videos/raw/{file_id}_original{file_extension}"
         
-        # GCS クライアントを初期化
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(gcs_blob_name)
-        
         # Signed URLを生成（15分間有効）
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(minutes=15),
-            method="PUT",
+        signed_url = storage_backend.signed_url(
+            gcs_blob_name,
+            "PUT",
+            timedelta(minutes=15),
             content_type=request.contentType,
             headers={
                 'x-goog-content-length-range': '0,104857600'  # 100MB制限
@@ -1287,64 +3989,71 @@ async def generate_signed_url(request: SignedUrlRequest):
         logger.error(f"Failed to generate signed URL: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to generate upload URL: {str(e)}")
 
-@app.post("/process-uploaded-video", response_model=FullVideoUploadResponse)
-async def process_uploaded_video(request: VideoProcessRequest):
-    """GCSにアップロードされた動画を処理・最適化する"""
-    if not GCS_BUCKET_NAME:
-        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+async def run_uploaded_video_pipeline(
+    gcs_blob_name: str,
+    original_file_name: str,
+    request: Optional[Request] = None,
+    report: ProgressCallback = _ignore_progress,
+) -> FullVideoUploadResponse:
+    """ストレージにアップロード済みの動画をダウンロードし、最適化して保存し直す"""
+    # 一時ファイルパスを生成
+    video_id = gcs_blob_name.split('/')[-1].split('_')[0]  # Extract video ID
+    original_path = UPLOAD_DIR / f"{video_id}_original.mp4"
+    optimized_path = UPLOAD_DIR / f"{video_id}_optimized.mp4"
     
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        source_blob = bucket.blob(request.gcsBlobName)
-        
-        # アップロードされたファイルの存在確認
-        if not source_blob.exists():
+        # ストレージが計算済みのMD5で重複を調べ、一致すればダウンロードせずに前回の結果を返す
+        report("download", 0.0)
+        source_blob = await run_in_threadpool(storage_backend.get_blob, gcs_blob_name)
+        if source_blob is None:
             raise HTTPException(status_code=404, detail="Uploaded file not found")
         
-        # ファイルサイズチェック（100MB制限）
-        blob_size = source_blob.size
+        # ファイルサイズチェック（100MB制限）。ダウンロードする前にblobのサイズで判定する
         MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
-        if blob_size > MAX_FILE_SIZE:
-            source_blob.delete()  # 制限を超えたファイルを削除
+        if source_blob.size > MAX_FILE_SIZE:
+            await run_in_threadpool(storage_backend.delete, gcs_blob_name)  # 制限を超えたファイルを削除
             raise HTTPException(status_code=413, detail=f"File size exceeds {MAX_FILE_SIZE // (1024*1024)}MB limit")
         
-        # 一時ファイルパスを生成
-        video_id = request.gcsBlobName.split('/')[-1].split('_')[0]  # Extract video ID
-        original_path = UPLOAD_DIR / f"{video_id}_original.mp4"
-        optimized_path = UPLOAD_DIR / f"{video_id}_optimized.mp4"
+        fingerprint = md5_hex_from_blob(source_blob)
+        duplicate = await run_in_threadpool(find_duplicate_upload, fingerprint, original_file_name)
+        if duplicate is not None:
+            logger.info(f"Duplicate upload (md5={fingerprint}), reusing {duplicate.gcsBlobName}")
+            await run_in_threadpool(storage_backend.delete, gcs_blob_name)
+            return duplicate
         
-        # GCSから一時ファイルにダウンロード
-        source_blob.download_to_filename(str(original_path))
-        logger.info(f"Downloaded file from GCS: {blob_size} bytes")
+        # GCSから一時ファイルにダウンロード（404なら見つからない）
+        if not await run_in_threadpool(storage_backend.download_to_file, gcs_blob_name, str(original_path)):
+            raise HTTPException(status_code=404, detail="Uploaded file not found")
+        if fingerprint is None:
+            fingerprint = await run_in_threadpool(file_md5_hex, str(original_path))
+        logger.info(f"Downloaded file from GCS: {source_blob.size} bytes")
         
         # 動画の長さをチェック
-        duration_cmd = [
-            'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', str(original_path)
-        ]
-        duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-        original_duration = float(duration_result.stdout.strip()) if duration_result.returncode == 0 else 0
+        report("probe", 0.05)
+        media_info = await probe_media_info(str(original_path))
+        original_duration = media_info.duration if media_info else 0
         
         # 30秒制限チェック
         if original_duration > 30:
             original_path.unlink()  # ローカルファイル削除
-            source_blob.delete()    # GCSファイル削除
+            await run_in_threadpool(storage_backend.delete, gcs_blob_name)    # GCSファイル削除
             raise HTTPException(status_code=400, detail="Video must be 30 seconds or shorter")
         
         # 動画を最適化
-        optimization_result = optimize_video_ffmpeg(str(original_path), str(optimized_path), max_duration=30.0)
-        
-        # 元ファイルを削除（容量節約）
-        original_path.unlink()
-        source_blob.delete()
+        report("transcode", 0.1)
+        optimization_result = await optimize_video_ffmpeg(
+            str(original_path), str(optimized_path), max_duration=30.0, request=request,
+            media_info=media_info, on_progress=transcode_progress_reporter(report)
+        )
         
         # 最適化された動画をGCSにアップロード
+        report("gcs-upload", 0.8)
         optimized_blob_name = f"videos/{video_id}_optimized.mp4"
-        optimized_blob = bucket.blob(optimized_blob_name)
+        hls_manifest = await store_optimized_video(optimized_path, optimized_blob_name, optimization_result['mediaInfo'])
         
-        with open(optimized_path, "rb") as video_file:
-            optimized_blob.upload_from_file(video_file, content_type="video/mp4")
+        # 元ファイルを削除（容量節約）。保存が終わるまで残しておき、ジョブの再実行に備える
+        original_path.unlink()
+        await run_in_threadpool(storage_backend.delete, gcs_blob_name)
         
         # ローカルの最適化ファイルを削除
         optimized_path.unlink()
@@ -1354,23 +4063,26 @@ async def process_uploaded_video(request: VideoProcessRequest):
         
         # メタデータ作成
         metadata = VideoMetadata(
-            originalFileName=request.originalFileName,
+            originalFileName=original_file_name,
             originalSize=optimization_result['originalSize'],
             originalDuration=original_duration,
             optimizedSize=optimization_result['optimizedSize'],
             optimizedDuration=optimization_result['optimizedDuration'],
-            compressionRatio=optimization_result['compressionRatio']
+            compressionRatio=optimization_result['compressionRatio'],
+            processingPath=optimization_result['processingPath']
         )
         
+        logger.info(f"Video processing completed successfully: {video_id}")
+        
         # レスポンス作成
         response = FullVideoUploadResponse(
             gcsBlobName=optimized_blob_name,
             videoId=video_id,
             metadata=metadata,
-            previewUrl=preview_url
+            previewUrl=preview_url,
+            hlsManifestUrl=f"/video/{video_id}/hls/{HLS_MASTER_PLAYLIST}" if hls_manifest else None
         )
-        
-        logger.info(f"Video processing completed successfully: {video_id}")
+        await run_in_threadpool(record_upload_fingerprint, fingerprint, response)
         return response
         
     except HTTPException:
@@ -1378,12 +4090,329 @@ async def process_uploaded_video(request: VideoProcessRequest):
     except Exception as e:
         # エラー時のクリーンアップ
         for path in [original_path, optimized_path]:
-            if 'path' in locals() and path.exists():
+            if path.exists():
                 path.unlink()
         
         logger.error(f"Video processing error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
 
+@app.post("/process-uploaded-video", response_model=FullVideoUploadResponse)
+async def process_uploaded_video(request: VideoProcessRequest, http_request: Request):
+    """GCSにアップロードされた動画を処理・最適化する"""
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+    
+    return await run_uploaded_video_pipeline(request.gcsBlobName, request.originalFileName, request=http_request)
+
+# Background job queue
+class JobManager:
+    """トランスコードや分析をHTTPリクエストから切り離して実行するジョブキュー
+
+    ジョブの状態は JOBS_DIR にJSONとして保存し、プロセスが再起動しても
+    未完了のジョブはキューに戻して再実行する。状態の変化は購読者（SSE）に配信する。
+    """
+
+    FINISHED_STATES = ("succeeded", "failed")
+
+    def __init__(self, jobs_dir: Path, workers: int, retention_sec: int):
+        self.jobs_dir = jobs_dir
+        self.workers = max(1, workers)
+        self.retention_sec = retention_sec
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._handlers: Dict[str, Callable] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: Callable) -> None:
+        """handler(payload, report) は結果のモデルを返すコルーチン"""
+        self._handlers[kind] = handler
+
+    def _job_path(self, job_id: str) -> Path:
+        return self.jobs_dir / f"{job_id}.json"
+
+    def _persist(self, job: Dict[str, Any]) -> None:
+        path = self._job_path(job["jobId"])
+        tmp_path = path.with_suffix(".json.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(job, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to persist job {job['jobId']}: {e}")
+
+    @staticmethod
+    def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in job.items() if key != "payload"}
+
+    def _update(self, job: Dict[str, Any], persist: bool = True, **fields) -> None:
+        job.update(fields)
+        job["updatedAt"] = datetime.now().isoformat()
+        if persist:
+            self._persist(job)
+        for queue in self._subscribers.get(job["jobId"], []):
+            queue.put_nowait(self.public_view(job))
+
+    async def start(self) -> None:
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        requeued = 0
+        for path in sorted(self.jobs_dir.glob("*.json"), key=lambda p: p.stat().st_mtime):
+            try:
+                with open(path) as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable job file {path}: {e}")
+                continue
+            self._jobs[job["jobId"]] = job
+            if job["state"] not in self.FINISHED_STATES:
+                # 実行途中で止まったジョブは最初からやり直す
+                self._update(job, state="queued", stage=None, progress=0.0, detail={})
+                self._queue.put_nowait(job["jobId"])
+                requeued += 1
+        self._prune()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Job manager started: workers={self.workers}, requeued={requeued}")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        stage: Optional[str] = None,
+        progress: float = 0.0,
+        detail: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """ジョブを登録する。受信済みの段階があれば stage/progress/detail で初期状態に反映する"""
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Job queue is not running")
+        now = datetime.now().isoformat()
+        job = {
+            "jobId": str(uuid.uuid4()),
+            "kind": kind,
+            "state": "queued",
+            "stage": stage,
+            "progress": progress,
+            "detail": detail or {},
+            "createdAt": now,
+            "updatedAt": now,
+            "payload": payload,
+            "result": None,
+            "error": None,
+        }
+        self._jobs[job["jobId"]] = job
+        self._persist(job)
+        self._queue.put_nowait(job["jobId"])
+        logger.info(f"Job submitted: {job['jobId']} ({kind}), queue size: {self._queue.qsize()}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._jobs.get(job_id)
+
+    async def events(self, job_id: str, keepalive_sec: float):
+        """ジョブの状態を変化のたびに返す非同期ジェネレータ。完了で終了し、無通信時はNoneを返す"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, []).append(queue)
+        try:
+            event = self.public_view(job)
+            yield event
+            while event["state"] not in self.FINISHED_STATES:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=keepalive_sec)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield event
+        finally:
+            subscribers = self._subscribers.get(job_id, [])
+            if queue in subscribers:
+                subscribers.remove(queue)
+            if not subscribers:
+                self._subscribers.pop(job_id, None)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                job = self._jobs.get(job_id)
+                if job is not None and job["state"] == "queued":
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _reporter(self, job: Dict[str, Any]) -> ProgressCallback:
+        def apply(stage: str, progress: float, detail: Optional[Dict[str, Any]]) -> None:
+            # 進捗値だけの更新はメモリ上に留め、段階が変わった時だけ保存する
+            self._update(
+                job, persist=stage != job["stage"],
+                stage=stage, progress=round(progress, 3), detail=detail or {}
+            )
+
+        def report(stage: str, progress: float, detail: Optional[Dict[str, Any]] = None) -> None:
+            # スレッドプールで動く分析処理からも呼ばれるため、イベントループ上で反映する
+            try:
+                in_loop = asyncio.get_running_loop() is self._loop
+            except RuntimeError:
+                in_loop = False
+            if in_loop:
+                apply(stage, progress, detail)
+            else:
+                self._loop.call_soon_threadsafe(apply, stage, progress, detail)
+
+        return report
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        handler = self._handlers.get(job["kind"])
+        if handler is None:
+            self._update(job, state="failed", error=f"Unknown job kind: {job['kind']}")
+            return
+
+        self._update(job, state="running")
+
+        start_time = time.perf_counter()
+        try:
+            result = await handler(job["payload"], self._reporter(job))
+        except HTTPException as e:
+            self._update(job, state="failed", error=str(e.detail))
+        except Exception as e:
+            logger.error(f"Job {job['jobId']} failed: {type(e).__name__}: {str(e)}")
+            self._update(job, state="failed", error=str(e))
+        else:
+            self._update(job, state="succeeded", stage="done", progress=1.0, result=jsonable_encoder(result))
+        logger.info(f"Job {job['jobId']} finished: {job['state']} in {time.perf_counter() - start_time:.1f}s")
+        self._prune()
+
+    def _prune(self) -> None:
+        """保持期間を過ぎた完了済みジョブを削除する"""
+        cutoff = datetime.now() - timedelta(seconds=self.retention_sec)
+        for job_id, job in list(self._jobs.items()):
+            if job["state"] in self.FINISHED_STATES and datetime.fromisoformat(job["updatedAt"]) < cutoff:
+                del self._jobs[job_id]
+                self._job_path(job_id).unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, Any]:
+        states: Dict[str, int] = {}
+        for job in self._jobs.values():
+            states[job["state"]] = states.get(job["state"], 0) + 1
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "states": states,
+        }
+
+async def _run_upload_full_video_job(payload: Dict[str, Any], report: ProgressCallback) -> FullVideoUploadResponse:
+    return await run_full_video_pipeline(
+        Path(payload["filePath"]), payload["fileId"], payload["originalFileName"], report=report,
+        fingerprint=payload.get("fingerprint")
+    )
+
+async def _run_process_uploaded_video_job(payload: Dict[str, Any], report: ProgressCallback) -> FullVideoUploadResponse:
+    return await run_uploaded_video_pipeline(payload["gcsBlobName"], payload["originalFileName"], report=report)
+
+async def _run_analyze_range_job(payload: Dict[str, Any], report: ProgressCallback) -> AnalysisResponse:
+    settings = RangeAnalysisSettings(**payload["settings"])
+    output_language = payload["outputLanguage"]
+    flight_key = range_analysis_flight_key(settings, output_language)
+    result, _ = await run_in_threadpool(analysis_flight.do, flight_key, run_range_analysis, settings, output_language, report)
+    return result
+
+job_manager = JobManager(JOBS_DIR, TRANSCODE_WORKERS, JOB_RETENTION_SEC)
+job_manager.register("upload-full-video", _run_upload_full_video_job)
+job_manager.register("process-uploaded-video", _run_process_uploaded_video_job)
+job_manager.register("analyze-range", _run_analyze_range_job)
+
+@app.on_event("startup")
+async def start_job_manager():
+    await job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_job_manager():
+    await job_manager.stop()
+
+def job_submit_response(job: Dict[str, Any]) -> JobSubmitResponse:
+    return JobSubmitResponse(
+        jobId=job["jobId"],
+        state=job["state"],
+        statusUrl=f"/jobs/{job['jobId']}",
+        eventsUrl=f"/jobs/{job['jobId']}/events"
+    )
+
+@app.post("/jobs/upload-full-video", response_model=JobSubmitResponse, status_code=202)
+async def submit_upload_full_video_job(file: UploadFile = File(...)):
+    """動画を受け取った時点でジョブIDを返し、最適化と保存はバックグラウンドで行う"""
+    validate_full_video_upload(file)
+    file_id, original_path, fingerprint = await receive_full_video_upload(file)
+    # 受信はジョブ登録前に終わっているので、upload段階は完了済みとして記録する
+    job = job_manager.submit("upload-full-video", {
+        "filePath": str(original_path),
+        "fileId": file_id,
+        "originalFileName": file.filename or "video.mp4",
+        "fingerprint": fingerprint,
+    }, stage="upload", progress=0.05, detail={"bytes": original_path.stat().st_size})
+    return job_submit_response(job)
+
+@app.post("/jobs/process-uploaded-video", response_model=JobSubmitResponse, status_code=202)
+async def submit_process_uploaded_video_job(request: VideoProcessRequest):
+    """アップロード済み動画の処理をジョブとして登録する"""
+    if not GCS_BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="GCS_BUCKET_NAME not configured")
+    
+    job = job_manager.submit("process-uploaded-video", {
+        "gcsBlobName": request.gcsBlobName,
+        "originalFileName": request.originalFileName,
+    })
+    return job_submit_response(job)
+
+@app.post("/jobs/analyze-range", response_model=JobSubmitResponse, status_code=202)
+async def submit_analyze_range_job(settings: RangeAnalysisSettings, x_language: Optional[str] = Header(None, alias="X-Language")):
+    """範囲分析をジョブとして登録する。結果は /jobs/{job_id} で取得する"""
+    validate_range_analysis_settings(settings)
+    job = job_manager.submit("analyze-range", {
+        "settings": jsonable_encoder(settings),
+        "outputLanguage": resolve_output_language(x_language),
+    })
+    return job_submit_response(job)
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job_status(job_id: str):
+    """ジョブの状態・進捗・完了時の結果を返す"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JobStatusResponse(**job_manager.public_view(job))
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """ジョブの進捗を Server-Sent Events で配信する（upload / transcode / gcs-upload / analysis 等の各段階）"""
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        async for event in job_manager.events(job_id, JOB_EVENTS_KEEPALIVE_SEC):
+            if event is None:
+                # プロキシにアイドル切断されないようコメント行を送る
+                yield ": keepalive\n\n"
+                continue
+            event_type = event["state"] if event["state"] in JobManager.FINISHED_STATES else "progress"
+            yield sse_event(event_type, event)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/logs", response_model=LogResponse)
 async def get_application_logs(limit: int = 50):
     """アプリケーションのログを取得する"""
@@ -1396,7 +4425,7 @@ async def get_application_logs(limit: int = 50):
             '--format=json'
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        result = await run_process(cmd, timeout=30, limit=False)
         
         if result.returncode != 0:
             logger.error(f"Failed to fetch logs: {result.stderr}")